@@ -0,0 +1,216 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from ansi import ansi_8bit_colors, ansi_4bit_colors_fg, ansi_4bit_colors_bg
+
+# every CSI sequence, only SGR ('m') ones change the style, the rest are dropped
+csi_pattern = re.compile(r'\033\[([0-9;]*)([A-Za-z])')
+
+DEFAULT_FG = 'lime'
+DEFAULT_BG = 'black'
+
+MEMO_MAX_CHARS = 16 * 1024 * 1024
+
+memo_lock = threading.Lock()
+memo = OrderedDict()
+memo_chars = 0
+memo_max_chars = MEMO_MAX_CHARS
+
+
+class Style(object):
+    __slots__ = ['fg', 'bg', 'bold', 'faint', 'italic', 'underline', 'strike', 'inverse', 'hidden']
+
+    def __init__(self, key=None):
+        if key is None:
+            self.reset()
+        else:
+            (self.fg, self.bg, self.bold, self.faint, self.italic,
+             self.underline, self.strike, self.inverse, self.hidden) = key
+
+    def reset(self):
+        self.fg = None
+        self.bg = None
+        self.bold = False
+        self.faint = False
+        self.italic = False
+        self.underline = False
+        self.strike = False
+        self.inverse = False
+        self.hidden = False
+
+    def key(self):
+        return (self.fg, self.bg, self.bold, self.faint, self.italic,
+                self.underline, self.strike, self.inverse, self.hidden)
+
+
+DEFAULT_STYLE = Style().key()
+
+
+def extended_color(params, i):
+    # 38/48 followed by 5;n or 2;r;g;b, returns (color or None, index after it)
+    if i < len(params) and params[i] == 5:
+        if i + 1 < len(params):
+            return ansi_8bit_colors.get(str(params[i + 1])), i + 2
+        return None, i + 1
+    if i < len(params) and params[i] == 2:
+        rgb = params[i + 1:i + 4]
+        if len(rgb) == 3 and all(c <= 255 for c in rgb):
+            return f'rgb({rgb[0]},{rgb[1]},{rgb[2]})', i + 4
+        return None, i + 4
+    return None, i
+
+
+def apply_sgr(style, param_string):
+    params = [int(p) if p else 0 for p in param_string.split(';')]
+    i = 0
+    while i < len(params):
+        p = params[i]
+        i += 1
+        if p == 0:
+            style.reset()
+        elif p == 1:
+            style.bold = True
+        elif p == 2:
+            style.faint = True
+        elif p == 3:
+            style.italic = True
+        elif p == 4:
+            style.underline = True
+        elif p == 7:
+            style.inverse = True
+        elif p == 8:
+            style.hidden = True
+        elif p == 9:
+            style.strike = True
+        elif p == 22:
+            style.bold = style.faint = False
+        elif p == 23:
+            style.italic = False
+        elif p == 24:
+            style.underline = False
+        elif p == 27:
+            style.inverse = False
+        elif p == 28:
+            style.hidden = False
+        elif p == 29:
+            style.strike = False
+        elif p == 38:
+            color, i = extended_color(params, i)
+            if color:
+                style.fg = color
+        elif p == 39:
+            style.fg = None
+        elif p == 48:
+            color, i = extended_color(params, i)
+            if color:
+                style.bg = color
+        elif p == 49:
+            style.bg = None
+        elif str(p) in ansi_4bit_colors_fg:
+            style.fg = ansi_4bit_colors_fg[str(p)]
+        elif str(p) in ansi_4bit_colors_bg:
+            style.bg = ansi_4bit_colors_bg[str(p)]
+
+
+# images reuse a handful of colors over and over, so both the style a sequence
+# leads to and the css for a style are looked up rather than recomputed
+transitions = {}
+css_cache = {}
+CACHE_MAX_ITEMS = 100000
+
+
+def next_style(key, param_string):
+    style = Style(key)
+    apply_sgr(style, param_string)
+    new_key = style.key()
+    if len(transitions) < CACHE_MAX_ITEMS:
+        transitions[(key, param_string)] = new_key
+    return new_key
+
+
+def style_css(key):
+    fg, bg, bold, faint, italic, underline, strike, inverse, hidden = key
+    if inverse:
+        fg, bg = bg or DEFAULT_BG, fg or DEFAULT_FG
+    rules = []
+    if fg:
+        rules.append(f'color:{fg}')
+    if bg:
+        rules.append(f'background:{bg}')
+    if bold:
+        rules.append('font-weight:bold')
+    if faint:
+        rules.append('opacity:0.5')
+    if italic:
+        rules.append('font-style:italic')
+    if underline or strike:
+        rules.append('text-decoration:' + ' '.join(
+            d for d, on in [('underline', underline), ('line-through', strike)] if on))
+    if hidden:
+        rules.append('visibility:hidden')
+    css = ';'.join(rules)
+    if len(css_cache) < CACHE_MAX_ITEMS:
+        css_cache[key] = css
+    return css
+
+
+def transcode(content):
+    # split() gives [text, params, command, text, params, command, ..., text]
+    parts = csi_pattern.split(content)
+    out = []
+    style = DEFAULT_STYLE
+    open_css = ''
+    for i in range(0, len(parts), 3):
+        text = parts[i]
+        if text:
+            css = css_cache.get(style)
+            if css is None:
+                css = style_css(style)
+            if css != open_css:
+                # adjacent runs with the same style end up in one span
+                if open_css:
+                    out.append('</span>')
+                if css:
+                    out.append(f'<span style="{css}">')
+                open_css = css
+            out.append(text)
+        if i + 2 < len(parts) and parts[i + 2] == 'm':
+            params = parts[i + 1]
+            new_style = transitions.get((style, params))
+            style = new_style if new_style is not None else next_style(style, params)
+    if open_css:
+        out.append('</span>')
+    return ''.join(out)
+
+
+def set_memo_limit(max_chars):
+    global memo_chars, memo_max_chars
+    with memo_lock:
+        memo_max_chars = max_chars
+        while memo_chars > memo_max_chars and memo:
+            _, evicted = memo.popitem(last=False)
+            memo_chars -= len(evicted)
+
+
+def convert_ansi_to_html(content):
+    global memo_chars
+    if '\033' not in content:
+        return content
+    key = hashlib.sha1(content.encode('utf-8', 'surrogatepass')).digest()
+    with memo_lock:
+        html = memo.get(key)
+        if html is not None:
+            memo.move_to_end(key)
+            return html
+
+    html = transcode(content)
+
+    with memo_lock:
+        if key not in memo:
+            memo[key] = html
+            memo_chars += len(html)
+            while memo_chars > memo_max_chars and memo:
+                _, evicted = memo.popitem(last=False)
+                memo_chars -= len(evicted)
+    return html
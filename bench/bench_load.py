@@ -0,0 +1,107 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+from fake_backend import add_arguments, backend_from_arguments
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# end to end: the app served over http against a fake backend, hit by a few
+# client threads for a while. reports req/s, latency percentiles and memory.
+# usage: python bench/bench_load.py [--duration 20] [--concurrency 8] [--latency 0.05] [--warm]
+
+PATHS = [
+    '/cl2/t/', '/cl2/t/?page=2', '/lc/i/', '/cldig/n/', '/cl2/t/thread/1',
+    '/all/t/', '/search?q=words+search', '/cl2/t/updates?since=1',
+]
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        return 0.0
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p / 100), len(values) - 1)] if values else 0.0
+
+
+def client(url, paths, deadline, results):
+    session = requests.Session()
+    while time.time() < deadline:
+        path = random.choice(paths)
+        start = time.perf_counter()
+        try:
+            ok = session.get(url + path).status_code < 500
+        except requests.RequestException:
+            ok = False
+        results.append((path, time.perf_counter() - start, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warm', action='store_true', help='run the cache warmer like production does')
+    parser.add_argument('--paths', nargs='*', default=PATHS)
+    args = parser.parse_args()
+
+    backend_url, _ = backend_from_arguments(args).serve()
+    # a fresh board store so earlier runs don't make this one look fast
+    os.environ['BOARD_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'boards.sqlite')
+    os.environ['WARM_CACHE'] = '1' if args.warm else '0'
+    import flask_app
+    for backend in flask_app.backends:
+        backend.url = backend_url
+    flask_app.start_warmer()
+
+    server = make_server('127.0.0.1', 0, flask_app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    print(f'app at {url}, fake backend at {backend_url}, {rss_mb():.0f}MB before the first request')
+
+    start = time.perf_counter()
+    requests.get(url + args.paths[0])
+    print(f'cold {args.paths[0]}: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+    results = []
+    deadline = time.time() + args.duration
+    clients = [threading.Thread(target=client, args=(url, args.paths, deadline, results)) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    server.shutdown()
+
+    print(f'{len(results)} requests in {args.duration:.0f}s with {args.concurrency} clients: {len(results) / args.duration:.1f} req/s, '
+        f'{sum(1 for _, _, ok in results if not ok)} failed')
+    print(f'{"path":<28} {"count":>6} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for path in sorted(set(path for path, _, _ in results)) + ['all']:
+        latencies = sorted(secs for p, secs, _ in results if path in (p, 'all'))
+        print(f'{path:<28} {len(latencies):>6} ' + ' '.join(
+            f'{percentile(latencies, p) * 1000:8.1f}' for p in [50, 90, 99, 100]))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000 if resource else 0
+    print(f'memory: {rss_mb():.0f}MB now, {peak:.0f}MB peak (includes the fake backend and clients)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('WARM_CACHE', '0')
+from PIL import Image
+from ansi_to_html import convert_ansi_to_html, transcode
+from image_to_ansi import MODES, image_to_ansi
+from fake_backend import ansi_image, make_board
+from bench_tree import bench as bench_tree
+
+# usage: python bench/bench_micro.py [ansi|tree|image ...]
+
+
+def best_of(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_ansi():
+    random.seed(1)
+    # every image cell a random color, the worst case for the style caches
+    posts = [post['content'] for post in make_board(500, 50, 0.1, 0.2, 60)]
+    chars = sum(len(post) for post in posts)
+    secs = best_of(lambda: [transcode(post) for post in posts], repeat=3)
+    print(f'transcode         {len(posts)} posts {chars / 1e6:6.1f}M chars  {secs * 1000:8.1f} ms  {chars / secs / 1e6:6.1f}M chars/s')
+    image = ansi_image(200, 100)
+    secs = best_of(lambda: transcode(image), repeat=3)
+    print(f'transcode image   200x100 cells          {secs * 1000:8.1f} ms')
+    convert_ansi_to_html(image)
+    secs = best_of(lambda: convert_ansi_to_html(image))
+    print(f'memoized image    200x100 cells          {secs * 1000:8.1f} ms')
+
+
+def bench_image():
+    random.seed(1)
+    img = Image.new('RGB', (640, 480))
+    img.putdata([(x % 256, y % 256, (x * y) % 256) for y in range(480) for x in range(640)])
+    for mode in ['auto'] + MODES:
+        for char_limit in [50000, 80000]:
+            secs = best_of(lambda: image_to_ansi(img, char_limit, mode), repeat=3)
+            print(f'image_to_ansi     640x480 {mode:>7} {char_limit:>6} chars  {secs * 1000:8.1f} ms')
+
+
+def bench_sort():
+    for shape in ['random', 'chains', 'chain']:
+        bench_tree(100000, shape)
+
+
+BENCHMARKS = {'ansi': bench_ansi, 'tree': bench_sort, 'image': bench_image}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,74 @@
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('WARM_CACHE', '0')
+from flask_app import Post, sort_posts, add_post
+
+# usage: python bench/bench_tree.py [num_posts ...]
+
+
+def make_board(num_posts, shape):
+    posts = []
+    for i in range(1, num_posts + 1):
+        if shape == 'chain':
+            # one reply chain through the whole board
+            reply_to = i - 1
+        elif shape == 'chains':
+            # a few hundred long reply chains
+            reply_to = max(i - 300, 0)
+        else:
+            reply_to = 0 if i < 3 or random.random() < 0.05 else random.randint(max(1, i - 2000), i - 1)
+        posts.append(Post(i, reply_to, '2020-01-01 00:00:00', 0.0, f'post {i}'))
+    return posts
+
+
+def link(posts):
+    posts_lookup = {post.id: post for post in posts}
+    roots = []
+    replies = {}
+    for post in posts:
+        if post.parent == 0:
+            roots.append(post)
+        else:
+            replies.setdefault(post.parent, []).append(post)
+    for id, post_replies in replies.items():
+        posts_lookup[id].replies = post_replies
+    return roots, posts_lookup
+
+
+def bench(num_posts, shape):
+    posts = make_board(num_posts, shape)
+    roots, posts_lookup = link(posts)
+    start = time.perf_counter()
+    roots = sort_posts(roots)
+    full = time.perf_counter() - start
+
+    new_posts = [Post(num_posts + i, random.randint(1, num_posts), '2020-01-01 00:00:00', 0.0, 'new') for i in range(1, 101)]
+    start = time.perf_counter()
+    for post in new_posts:
+        posts_lookup[post.id] = post
+        roots = add_post(roots, posts_lookup, post)
+    incremental = (time.perf_counter() - start) / len(new_posts)
+
+    # what a sorted board of this size keeps alive, measured on a second copy so
+    # tracing doesn't slow down the timings
+    tracemalloc.start()
+    copy = link(make_board(num_posts, shape))[0]
+    copy = sort_posts(copy)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copy
+
+    print(f'{shape:>8} {num_posts:>9} posts  full sort {full * 1000:9.1f} ms  add_post {incremental * 1e6:9.1f} us  {memory / num_posts:6.0f} bytes/post')
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    for shape in ['random', 'chains', 'chain']:
+        for num_posts in sizes:
+            bench(num_posts, shape)
@@ -0,0 +1,167 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# a stand-in cyberland server for benchmarks, speaks the part of the protocol
+# the app uses: GET /<board>/?num=&thread=&offset= (newest first) and
+# POST /<board>/ with content and replyTo.
+# usage: python bench/fake_backend.py [--port 8765] [--posts 2000] [--latency 0.05] [--failure-rate 0.01]
+
+BOARDS = ['t', 'n', 'o', 'i', 's', 'c']
+
+
+def ansi_image(width, height):
+    rows = []
+    for _ in range(height):
+        rows.append(''.join(f'\033[48;2;{random.randint(0, 255)};{random.randint(0, 255)};{random.randint(0, 255)}m ' for _ in range(width)))
+    return '\033[0m\n'.join(rows) + '\033[0m\n'
+
+
+def make_post(id, reply_to, image_density, image_size, when):
+    content = f'post {id} >>{reply_to} some words to search for http://example.com/{id} <b>'
+    if random.random() < image_density:
+        content = ansi_image(image_size, image_size // 2) + content
+    return {
+        'id': str(id),
+        'content': content,
+        'replyTo': str(reply_to),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(when)),
+    }
+
+
+def make_board(posts, depth, thread_rate, image_density, image_size):
+    # depth caps how far down a reply chain can go, thread_rate is how many
+    # posts start a new thread
+    board = []
+    depths = {}
+    start = time.time() - posts * 60
+    for id in range(1, posts + 1):
+        reply_to = 0
+        if id > 1 and random.random() >= thread_rate:
+            reply_to = random.randint(max(1, id - 500), id - 1)
+            if depths[reply_to] >= depth:
+                reply_to = 0
+        depths[id] = depths[reply_to] + 1 if reply_to else 0
+        board.append(make_post(id, reply_to, image_density, image_size, start + id * 60))
+    return board
+
+
+class FakeBackend(object):
+    def __init__(self, posts=2000, depth=50, thread_rate=0.1, image_density=0.05, image_size=60,
+            latency=0.0, failure_rate=0.0, seed=1):
+        random.seed(seed)
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.boards = {name: make_board(posts, depth, thread_rate, image_density if name == 'i' else 0, image_size)
+            for name in BOARDS}
+        self.requests = 0
+
+    def list_posts(self, name, thread, offset, num):
+        with self.lock:
+            posts = list(reversed(self.boards[name]))
+        if thread is not None:
+            posts = [post for post in posts if post['replyTo'] == thread]
+        return posts[offset:offset + num]
+
+    def add_post(self, name, content, reply_to):
+        with self.lock:
+            board = self.boards[name]
+            board.append({
+                'id': str(len(board) + 1),
+                'content': content,
+                'replyTo': reply_to,
+                'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+            })
+
+    def handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def misbehave(self):
+                with backend.lock:
+                    backend.requests += 1
+                if backend.latency:
+                    time.sleep(random.expovariate(1 / backend.latency))
+                if random.random() < backend.failure_rate:
+                    self.reply(random.choice([500, 502, 503]), b'<h1>oops</h1>', 'text/html')
+                    return True
+                return False
+
+            def do_GET(self):
+                if self.misbehave():
+                    return
+                url = urlparse(self.path)
+                name = url.path.strip('/')
+                if name not in backend.boards:
+                    self.reply(404, b'no such board', 'text/plain')
+                    return
+                query = parse_qs(url.query)
+                thread = query['thread'][0] if 'thread' in query else None
+                offset = int(query.get('offset', ['0'])[0])
+                num = int(query.get('num', ['50'])[0])
+                self.reply(200, json.dumps(backend.list_posts(name, thread, offset, num)).encode())
+
+            def do_POST(self):
+                if self.misbehave():
+                    return
+                name = urlparse(self.path).path.strip('/')
+                if name not in backend.boards:
+                    self.reply(404, b'no such board', 'text/plain')
+                    return
+                form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+                backend.add_post(name, form.get('content', [''])[0], form.get('replyTo', ['0'])[0])
+                self.reply(200, b'ok', 'text/plain')
+
+        return Handler
+
+    def serve(self, port=0):
+        # port 0 picks a free one, the url is returned
+        server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='fake-backend', daemon=True).start()
+        return f'http://127.0.0.1:{server.server_address[1]}', server
+
+
+def add_arguments(parser):
+    parser.add_argument('--posts', type=int, default=2000, help='posts per board')
+    parser.add_argument('--depth', type=int, default=50, help='longest reply chain')
+    parser.add_argument('--thread-rate', type=float, default=0.1, help='share of posts that start a thread')
+    parser.add_argument('--image-density', type=float, default=0.05, help='share of /i/ posts with an ansi image')
+    parser.add_argument('--image-size', type=int, default=60, help='ansi image width in cells')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean added latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with a 5xx')
+
+
+def backend_from_arguments(args):
+    return FakeBackend(posts=args.posts, depth=args.depth, thread_rate=args.thread_rate,
+        image_density=args.image_density, image_size=args.image_size,
+        latency=args.latency, failure_rate=args.failure_rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    url, server = backend_from_arguments(args).serve(args.port)
+    print(f'serving fake boards at {url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+import concurrent.futures
+from collections import namedtuple, OrderedDict
+from cache_store import LocalStore
+import event_loop
+from event_loop import blocking
+
+LEASE_POLL_SECS = 0.1
+
+CacheEntry = namedtuple('CacheEntry', ['board', 'time'])
+
+
+class CacheSlot(object):
+    def __init__(self):
+        self.entry = None
+        self.valid = False
+        self.future = None
+        self.reload = False
+        self.generation = 0
+
+
+class BoardCache(object):
+    # per-key single-flight cache: a key is only ever loaded once at a time,
+    # readers of a stale entry get the old one while a background refresh runs.
+    # loaders are coroutines, run on the event loop, and get the previous value
+    # (or None) so they can update it incrementally. the store is where other
+    # processes' boards and invalidations come from
+    def __init__(self, max_entries=64, store=None):
+        self.lock = threading.Lock()
+        self.store = store or LocalStore()
+        self.slots = OrderedDict()
+        self.max_entries = max_entries
+        self.counts = {'hit': 0, 'stale': 0, 'miss': 0}
+
+    def get(self, key, loader, ttl):
+        # for plain threads, a miss waits on the event loop
+        slot, entry, future, owner = self._lookup(key, loader, ttl, self.store.generation(key))
+        if future is None:
+            return entry
+        if owner:
+            event_loop.run(self._load(key, slot, loader, ttl))
+        return future.result()
+
+    async def get_async(self, key, loader, ttl):
+        slot, entry, future, owner = self._lookup(key, loader, ttl, await blocking(self.store.generation, key))
+        if future is None:
+            return entry
+        if owner:
+            await self._load(key, slot, loader, ttl)
+        return await asyncio.wrap_future(future)
+
+    def _lookup(self, key, loader, ttl, generation):
+        # (slot, entry, None, False) when there's an entry to hand out right away,
+        # otherwise (slot, None, future, owner): the caller waits on the future,
+        # after loading the key itself if it's the owner
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = CacheSlot()
+                self._evict()
+            self.slots.move_to_end(key)
+            if slot.valid and slot.generation != generation:
+                # someone posted through another process
+                self._invalidate_slot(slot)
+            if slot.valid:
+                if time.time() - slot.entry.time > ttl:
+                    self.counts['stale'] += 1
+                    if not slot.future:
+                        slot.future = concurrent.futures.Future()
+                        event_loop.submit(self._load(key, slot, loader, ttl))
+                else:
+                    self.counts['hit'] += 1
+                return slot, slot.entry, None, False
+            self.counts['miss'] += 1
+            owner = slot.future is None
+            if owner:
+                slot.future = concurrent.futures.Future()
+            return slot, None, slot.future, owner
+
+    def refresh(self, key, loader, ttl):
+        # reload in the background unless that's already happening, readers keep
+        # getting the current entry meanwhile. the (concurrent) future gets the
+        # new entry
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = CacheSlot()
+                self._evict()
+            if slot.future:
+                return slot.future
+            slot.future = future = concurrent.futures.Future()
+        event_loop.submit(self._load(key, slot, loader, ttl))
+        return future
+
+    async def _load(self, key, slot, loader, ttl):
+        while True:
+            try:
+                entry, generation = await self._load_shared(key, slot, loader, ttl)
+            except Exception as e:
+                with self.lock:
+                    future, slot.future, slot.reload = slot.future, None, False
+                    # a stale board beats an error page while the backend is down,
+                    # the old time makes the next reader try again
+                    stale = slot.entry
+                    slot.valid = stale is not None
+                if stale is None:
+                    future.set_exception(e)
+                    return
+                print(f'cache refresh failed, serving stale: {e!r}')
+                future.set_result(stale)
+                return
+
+            with self.lock:
+                slot.entry = entry
+                slot.generation = generation
+                # invalidated while loading: this result may predate the change, go again
+                if slot.reload:
+                    slot.reload = False
+                    continue
+                slot.valid = True
+                future, slot.future = slot.future, None
+            future.set_result(slot.entry)
+            return
+
+    async def _load_shared(self, key, slot, loader, ttl):
+        # another process may have loaded the board recently enough, otherwise
+        # load it ourselves, unless another process is already at it. the store
+        # is sqlite, so it's only ever called off the loop
+        generation = await blocking(self.store.generation, key)
+        newer_than = max(slot.entry.time if slot.entry else 0, time.time() - ttl)
+        mine = slot.entry.board if slot.entry else None
+        while True:
+            shared = await blocking(self.store.read, key, newer_than, generation, mine)
+            if shared is not None:
+                board, loaded_at = shared
+                return CacheEntry(board=board, time=loaded_at), generation
+            lease = await blocking(self.store.claim, key)
+            if lease:
+                break
+            await asyncio.sleep(LEASE_POLL_SECS)
+        try:
+            if slot.entry:
+                previous, previous_time = slot.entry
+            else:
+                # nothing in memory yet, whatever was stored last is still a
+                # better start than nothing
+                previous, previous_time = await blocking(self.store.read, key, 0, generation) or (None, 0)
+                if previous is not None:
+                    # however old it is, the loader can catch up on it first
+                    previous.restored = True
+            entry = CacheEntry(board=await loader(previous), time=time.time())
+            if entry.board is previous:
+                await blocking(self.store.touch, key, previous_time, entry.time, generation)
+            else:
+                await blocking(self.store.write, key, entry.board, entry.time, generation)
+        finally:
+            await blocking(self.store.release, key, lease)
+        return entry, generation
+
+    def cached(self, key):
+        # the entry a reader would get right away and its generation, or None
+        # while the key still has to be loaded
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None or not slot.valid:
+                return None
+            return slot.entry, slot.generation
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.slots))
+
+    def _evict(self):
+        while len(self.slots) > self.max_entries:
+            self.slots.popitem(last=False)
+
+    def invalidate(self, key):
+        # keeps the old value around as a base for the next (blocking) load
+        self.store.invalidate(key)
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self._invalidate_slot(slot)
+
+    def _invalidate_slot(self, slot):
+        slot.valid = False
+        if slot.future:
+            slot.reload = True
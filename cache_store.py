@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import threading
+import time
+
+LEASE_SECS = 30
+BUSY_TIMEOUT_SECS = 5
+# how long a worker trusts the generation it read last, posting through
+# this worker bumps it right away
+GENERATION_CHECK_SECS = 0.5
+
+
+class LocalStore(object):
+    # what BoardCache talks to besides its own memory. this one shares nothing,
+    # every process loads boards for itself
+    def generation(self, key):
+        return 0
+
+    def read(self, key, newer_than, generation, previous=None):
+        return None
+
+    def write(self, key, board, loaded_at, generation):
+        pass
+
+    def touch(self, key, previous_loaded_at, loaded_at, generation):
+        pass
+
+    def invalidate(self, key):
+        pass
+
+    def claim(self, key):
+        return True
+
+    def release(self, key, lease):
+        pass
+
+
+class SqliteStore(object):
+    # boards shared by every worker process on the host through one sqlite file.
+    # a board row holds when any worker last loaded it, a generation that posting
+    # bumps (so every worker drops its copy) and a lease, so only one worker at a
+    # time asks the backend for a board while the others wait for its result.
+    # the posts are rows of their own: between full syncs a board only grows, so
+    # writers append what's new and readers that have the same full sync read
+    # only what they're missing. the file outlives the workers, after a restart
+    # it's where boards start from.
+    # boards have max_id and full_sync_time, post_rows(board, since_id) gives the
+    # (id, parent, time, timestamp, content) rows newer than since_id and
+    # build(rows, full_sync_time, previous) makes a board of rows, added to
+    # previous if it's given
+    def __init__(self, path, post_rows, build):
+        self.path = path
+        self.post_rows = post_rows
+        self.build = build
+        self.local = threading.local()
+        self.generations_lock = threading.Lock()
+        self.generations = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connection() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS boards (
+                key TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL DEFAULT 0,
+                loaded_at REAL NOT NULL DEFAULT 0,
+                full_sync_time REAL,
+                max_id INTEGER NOT NULL DEFAULT 0,
+                lease_until REAL NOT NULL DEFAULT 0)''')
+            db.execute('''CREATE TABLE IF NOT EXISTS posts (
+                key TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                parent INTEGER NOT NULL,
+                time,
+                timestamp REAL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (key, id)) WITHOUT ROWID''')
+
+    def connection(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECS)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def ensure_row(self, db, key):
+        db.execute('INSERT OR IGNORE INTO boards (key) VALUES (?)', (key,))
+
+    def generation(self, key):
+        # asked on every request, so only every GENERATION_CHECK_SECS of sqlite
+        now = time.time()
+        with self.generations_lock:
+            cached = self.generations.get(key)
+        if cached is not None and now - cached[1] < GENERATION_CHECK_SECS:
+            return cached[0]
+        row = self.connection().execute('SELECT generation FROM boards WHERE key = ?', (key,)).fetchone()
+        generation = row[0] if row else 0
+        with self.generations_lock:
+            self.generations[key] = (generation, now)
+        return generation
+
+    def read(self, key, newer_than, generation, previous=None):
+        # (board, loaded_at) if some worker loaded the board after newer_than and
+        # nobody posted to it since, otherwise None. with a previous board from the
+        # same full sync only the posts it doesn't have yet are read
+        db = self.connection()
+        try:
+            # one snapshot for the board row and its posts
+            db.execute('BEGIN')
+            row = db.execute(
+                'SELECT loaded_at, full_sync_time, max_id FROM boards '
+                'WHERE key = ? AND generation = ? AND loaded_at > ? AND full_sync_time IS NOT NULL',
+                (key, generation, newer_than)).fetchone()
+            if row is None:
+                return None
+            loaded_at, full_sync_time, max_id = row
+            if previous is not None and previous.full_sync_time == full_sync_time and previous.max_id <= max_id:
+                if previous.max_id == max_id:
+                    return previous, loaded_at
+                rows = db.execute('SELECT id, parent, time, timestamp, content FROM posts WHERE key = ? AND id > ? ORDER BY id',
+                    (key, previous.max_id)).fetchall()
+            else:
+                previous = None
+                rows = db.execute('SELECT id, parent, time, timestamp, content FROM posts WHERE key = ? ORDER BY id',
+                    (key,)).fetchall()
+        finally:
+            db.rollback()
+        try:
+            return self.build(rows, full_sync_time, previous), loaded_at
+        except Exception as e:
+            print(f'unreadable shared board {key}: {e!r}')
+            return None
+
+    def write(self, key, board, loaded_at, generation):
+        # a board loaded before the last post may not have it, that one stays local.
+        # from the same full sync as the stored board only the newer posts are
+        # added, a newer full sync replaces them all and an older one is dropped
+        with self.connection() as db:
+            row = db.execute('SELECT full_sync_time, max_id FROM boards WHERE key = ? AND generation = ?',
+                (key, generation)).fetchone()
+            if row is None:
+                return
+            full_sync_time, max_id = row
+            if full_sync_time is not None and board.full_sync_time < full_sync_time:
+                return
+            if board.full_sync_time != full_sync_time:
+                db.execute('DELETE FROM posts WHERE key = ?', (key,))
+                max_id = 0
+            db.executemany('INSERT OR IGNORE INTO posts (key, id, parent, time, timestamp, content) VALUES (?, ?, ?, ?, ?, ?)',
+                ((key,) + row for row in self.post_rows(board, max_id)))
+            db.execute('UPDATE boards SET loaded_at = ?, full_sync_time = ?, max_id = ? WHERE key = ?',
+                (loaded_at, board.full_sync_time, max(max_id, board.max_id), key))
+
+    def touch(self, key, previous_loaded_at, loaded_at, generation):
+        # the board didn't change, note that it's still current. only if the row
+        # holds that same board and not some other worker's older one
+        with self.connection() as db:
+            db.execute('UPDATE boards SET loaded_at = ? WHERE key = ? AND generation = ? AND loaded_at = ?',
+                (loaded_at, key, generation, previous_loaded_at))
+
+    def invalidate(self, key):
+        with self.connection() as db:
+            self.ensure_row(db, key)
+            db.execute('UPDATE boards SET generation = generation + 1 WHERE key = ?', (key,))
+        with self.generations_lock:
+            self.generations.pop(key, None)
+
+    def claim(self, key):
+        # the lease to hand back to release, or None if another worker has it.
+        # a load moves between threads, so the lease goes with it and not with one
+        now = time.time()
+        with self.connection() as db:
+            self.ensure_row(db, key)
+            claimed = db.execute('UPDATE boards SET lease_until = ? WHERE key = ? AND lease_until < ?',
+                (now + LEASE_SECS, key, now)).rowcount == 1
+        return now + LEASE_SECS if claimed else None
+
+    def release(self, key, lease):
+        with self.connection() as db:
+            db.execute('UPDATE boards SET lease_until = 0 WHERE key = ? AND lease_until = ?', (key, lease))
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+MAX_MEMORY_CHARS = 16 * 1024 * 1024
+MAX_DISK_BYTES = 256 * 1024 * 1024
+
+
+def conversion_key(data, char_limit, mode, dither):
+    return f'{hashlib.sha256(data).hexdigest()}-{char_limit}-{mode}-{int(bool(dither))}'
+
+
+class ConversionCache(object):
+    # converted uploads by content hash, so the same image posted again (or to
+    # another backend with the same limit) isn't converted twice. LRU in memory,
+    # and written through to spill_dir if there is one, so other workers and
+    # restarts see it too
+    def __init__(self, max_chars=MAX_MEMORY_CHARS, spill_dir=None, max_disk_bytes=MAX_DISK_BYTES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.chars = 0
+        self.max_chars = max_chars
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(spill_dir))
+
+    def get(self, key):
+        with self.lock:
+            ansi = self.entries.get(key)
+            if ansi is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return ansi
+        ansi = self.read_spilled(key)
+        with self.lock:
+            if ansi is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(key, ansi)
+        return ansi
+
+    def put(self, key, ansi):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = ansi
+            self.chars += len(ansi)
+            while self.chars > self.max_chars and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.chars -= len(evicted)
+        self.spill(key, ansi)
+
+    def path(self, key):
+        return os.path.join(self.spill_dir, key + '.ansi')
+
+    def read_spilled(self, key):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def spill(self, key, ansi):
+        if not self.spill_dir or os.path.exists(self.path(key)):
+            return
+        data = ansi.encode('utf-8')
+        # workers can write the same key at once, each to its own tmp file
+        tmp = f'{self.path(key)}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self.path(key))
+        with self.lock:
+            self.disk_bytes += len(data)
+            over = self.disk_bytes > self.max_disk_bytes
+        if over:
+            self.trim_disk()
+
+    def trim_disk(self):
+        # oldest files first until we're back under the limit
+        files = sorted(os.scandir(self.spill_dir), key=lambda entry: entry.stat().st_mtime)
+        for entry in files:
+            with self.lock:
+                if self.disk_bytes <= self.max_disk_bytes:
+                    return
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                self.disk_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'chars': self.chars,
+                'disk_bytes': self.disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,43 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+
+BLOCKING_WORKERS = 4
+
+lock = threading.Lock()
+loop = None
+# sqlite and the cpu-heavy parts of a board load (escaping, transcoding,
+# sorting, indexing) run here so the loop keeps serving everyone else's i/o
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+
+
+def get_loop():
+    # one loop per process on its own thread: board loads, the /all and /search
+    # fan-out and the warmer all run on it. started on first use, so every
+    # gunicorn worker gets its own after forking
+    global loop
+    with lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='event-loop', daemon=True).start()
+        return loop
+
+
+def run(coroutine):
+    # for plain threads (flask routes, pollers): run a coroutine on the loop and
+    # wait for it. whatever it times counts towards this thread's Stages
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+def submit(coroutine):
+    # start a coroutine on the loop without waiting, from any thread. it gets a
+    # context of its own, so it doesn't report into whoever started it
+    return contextvars.Context().run(asyncio.run_coroutine_threadsafe, coroutine, get_loop())
+
+
+async def blocking(fn, *args):
+    # fn(*args) on the executor, with this task's context so its timings land
+    # in the same Stages
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(executor, context.run, fn, *args)
@@ -1,41 +1,101 @@
-import requests
 import re
-from flask import Flask, escape, request, redirect, get_flashed_messages, flash, make_response
-from collections import namedtuple
+import sys
+from flask import Flask, Response, escape, g, jsonify, request, redirect, get_flashed_messages, flash
+import asyncio
 import concurrent.futures
-import threading
 import time
-from ansi import ansi_8bit_colors
-from PIL import Image
-from image_to_ansi import image_to_ansi
-
-class BackendError(Exception):
-    def __init__(self, response):
-        super().__init__()
-        self.response = response
-
-cache_lock = threading.Lock()
-
-CacheEntry = namedtuple('CacheEntry', ['posts', 'time'])
-
-cache = {}
-
-
-def get_all_posts(backend_url, board_name, recent_first=True):
-    r = requests.get(f'{backend_url}/{board_name}/?num=999999999999999')
-    try:
-        posts = r.json()
-    except:
-        raise BackendError(r)
-    return posts
+import bisect
+import json
+import queue
+import os
+import tempfile
+import heapq
+import itertools
+from datetime import datetime, timezone
+from cache import BoardCache
+from cache_store import SqliteStore
+from ansi_to_html import convert_ansi_to_html, set_memo_limit
+from fragments import FragmentCache
+from page_cache import PageCache, encodings
+from live import LiveUpdates
+from upstream import BackendError, error_text, iter_json_list, upstream_for, upstream_latencies, upstream_stats
+from image_jobs import ImageJobs, ImageJobError, MAX_UPLOAD_BYTES
+from image_to_ansi import MODES
+from conversion_cache import ConversionCache
+from warmer import CacheWarmer
+from search import SearchIndex
+from metrics import Stages, timed, format_metrics, stage_series
+import event_loop
+from event_loop import blocking
+
+CACHE_STALE_SECS = 10
+FULL_SYNC_SECS = 300
+# a quiet board costs one post per refresh, the batch doubles while it's all new
+SYNC_PROBE = 1
+SYNC_MAX_BATCH = 3200
+AGGREGATE_TIMEOUT_SECS = 8
+# posts of a full fetch are escaped and transcoded off the loop this many at a time
+PREPARE_BATCH = 500
+# an event stream holds one of gunicorn's 50 threads, most are left for pages
+MAX_EVENT_STREAMS = 20
+# in-memory cache budgets, per worker. the defaults add up to about 96MB
+# (page bytes plus html and ansi chars), so workers * 96MB has to fit the dyno
+PAGE_CACHE_BYTES = int(os.environ.get('PAGE_CACHE_BYTES', 32 * 1024 * 1024))
+FRAGMENT_CACHE_CHARS = int(os.environ.get('FRAGMENT_CACHE_CHARS', 32 * 1024 * 1024))
+ANSI_MEMO_CHARS = int(os.environ.get('ANSI_MEMO_CHARS', 16 * 1024 * 1024))
+CONVERSION_CACHE_CHARS = int(os.environ.get('CONVERSION_CACHE_CHARS', 16 * 1024 * 1024))
+
+set_memo_limit(ANSI_MEMO_CHARS)
+fragment_cache = FragmentCache(max_chars=FRAGMENT_CACHE_CHARS)
+page_cache = PageCache(max_bytes=PAGE_CACHE_BYTES)
+live_updates = LiveUpdates(max_subscribers=MAX_EVENT_STREAMS)
+cache_warmer = CacheWarmer()
+search_index = SearchIndex()
+image_jobs = ImageJobs(cache=ConversionCache(max_chars=CONVERSION_CACHE_CHARS, spill_dir=os.environ.get('CONVERSION_CACHE_DIR')))
+deferred_posts = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='deferred-post')
+
+
+async def iter_all_posts(backend_url, board_name, num=999999999999999):
+    # a whole board can be a lot of json (big ansi images), the posts are handed
+    # out one by one as they come in instead of parsing the body in one go
+    r = await upstream_for(backend_url).get(f'/{board_name}/?num={num}')
+    if r.status != 200:
+        raise BackendError(r, text=await error_text(r))
+    return iter_json_list(r)
+
+
+async def get_new_posts(backend_url, board_name, since_id):
+    # asks for the newest posts in growing batches until the batch reaches back to
+    # a post we already have. returns None when the backend doesn't honor num or
+    # doesn't list newest first, the caller should do a full fetch then
+    # the batch is streamed like a full fetch, only the new posts are kept
+    num = SYNC_PROBE
+    while True:
+        new_posts = []
+        count = 0
+        last_id = None
+        posts = await iter_all_posts(backend_url, board_name, num=num)
+        try:
+            async for post in posts:
+                id = int(post['id'])
+                count += 1
+                if count > num or (last_id is not None and id >= last_id):
+                    return None
+                last_id = id
+                if id > since_id:
+                    new_posts.append(post)
+        finally:
+            await posts.aclose()
+        if count < num or last_id <= since_id:
+            return new_posts
+        if num >= SYNC_MAX_BATCH:
+            return None
+        num = min(num * 2, SYNC_MAX_BATCH)
 
 
 def max_id(post):
-    if post['replies']:
-        return max(
-            max_id(reply) for reply in post['replies']
-        )
-    return int(post['id'])
+    # highest id in the post's subtree, filled in by sort_posts/add_post
+    return post.bump
 
 """
 
@@ -97,102 +157,261 @@ def get_posts_for_board(board_name):
 
 
 def sort_posts(posts):
-    for post in posts:
-        post['replies'] = sort_posts(post['replies'])
-    posts = sorted(posts, key=lambda x: max_id(x), reverse=True)
+    # one pass over the whole tree, without recursion since reply chains can be
+    # thousands deep. children come before their parent in reversed preorder,
+    # so every bump id is computed exactly once
+    order = []
+    stack = list(posts)
+    while stack:
+        post = stack.pop()
+        order.append(post)
+        stack.extend(post.replies)
+    for post in reversed(order):
+        replies = tuple(sorted(post.replies, key=max_id, reverse=True))
+        post.replies = replies
+        post.bump = max(post.id, replies[0].bump) if replies else post.id
+    return sorted(posts, key=max_id, reverse=True)
+
+
+def insert_by_bump(posts, post):
+    # returns a new list, readers of the previous snapshot may be iterating the old one
+    posts = [p for p in posts if p is not post]
+    i = 0
+    while i < len(posts) and posts[i].bump > post.bump:
+        i += 1
+    posts.insert(i, post)
     return posts
 
-def convert_ansi_to_html(content):
-    new_content = []
-    i = 0
-    closing_stack = []
-    while i < len(content):
-        if content[i:i + 2] == '\033[':
-            i += 2
-            s = content[i:i + 20]
-            if s.startswith('0m'):
-                new_content.append(''.join(closing_stack))
-                closing_stack = []
-                i += 2
-                continue
-            m = re.match(r'(\d+);(\d+);(\d+);(\d+);(\d+)m', s)
-            if m: # 24bit
-                if m.group(1) == '38' and m.group(2) == '2':
-                    new_content.append(f'<span style="color:rgb({m.group(3)},{m.group(4)},{m.group(5)}">')
-                    closing_stack.append('</span>')
-                elif m.group(1) == '48' and m.group(2) == '2':
-                    new_content.append(f'<span style="background:rgb({m.group(3)},{m.group(4)},{m.group(5)}">')
-                    closing_stack.append('</span>')
-                i += len(m.group(0))
-            else:
-                m = re.match(r'(\d+);(\d+);(\d+)m', s)
-                if m: # bit
-                    if m.group(1) == '38' and m.group(2) == '5':
-                        color = ansi_8bit_colors.get(m.group(3))
-                        if color:
-                            new_content.append(f'<span style="color:{color}">')
-                            closing_stack.append('</span>')
-                            i += len(m.group(0))
-                    elif m.group(1) == '48' and m.group(2) == '5':
-                        color = ansi_8bit_colors.get(m.group(3))
-                        if color:
-                            new_content.append(f'<span style="background:{color}">')
-                            closing_stack.append('</span>')
-                            i += len(m.group(0))
 
-        else:
-            new_content.append(content[i])
-            i += 1
-    new_content.append(''.join(closing_stack))
-    return ''.join(new_content)
+def add_post(posts, posts_lookup, post):
+    # puts a new post into an already sorted tree, only the ancestors whose
+    # bump id changes get moved. returns the new list of threads
+    post.bump = post.id
+    node = post
+    seen = set()
+    while node.parent != 0 and node.id not in seen:
+        seen.add(node.id)
+        parent = posts_lookup.get(node.parent)
+        if parent is None:
+            if node is post:
+                print(f'missing post {post.parent}')
+            return posts
+        parent.replies = tuple(insert_by_bump(parent.replies, node))
+        if parent.bump >= node.bump:
+            return posts
+        parent.bump = node.bump
+        node = parent
+    if node.parent != 0:
+        return posts
+    return insert_by_bump(posts, node)
+
+class Post(object):
+    # every cached board keeps all of its posts, so no dict per post. replies is a
+    # tuple that gets replaced rather than changed, a render walking an older
+    # snapshot of the board doesn't see it move
+    __slots__ = ['id', 'parent', 'time', 'timestamp', 'content', 'bump', 'replies']
+
+    def __init__(self, id, parent, time, timestamp, content, bump=None, replies=()):
+        self.id = id
+        self.parent = parent
+        self.time = time
+        self.timestamp = timestamp
+        self.content = content
+        self.bump = id if bump is None else bump
+        self.replies = replies
+
+
+class BoardPosts(object):
+    def __init__(self, posts, posts_lookup, full_sync_time, restored=False):
+        self.posts = posts
+        self.posts_lookup = posts_lookup
+        self.ids = sorted(posts_lookup)
+        self.max_id = self.ids[-1] if self.ids else 0
+        self.full_sync_time = full_sync_time
+        # read back from the board store on a cold start rather than loaded by
+        # this process or adopted from another worker's fresh copy
+        self.restored = restored
+
+    def version(self):
+        # the same posts give the same version in every process, deletions only
+        # happen on a full sync
+        return f'{self.max_id}.{len(self.posts_lookup)}.{self.full_sync_time}'
+
+    def posts_since(self, since_id):
+        return [self.posts_lookup[id] for id in self.ids[bisect.bisect_right(self.ids, since_id):]]
+
+
+def post_rows(board_posts, since_id):
+    # what the board store keeps of a post, the tree is rebuilt from the parents
+    return [(post.id, post.parent, post.time, post.timestamp, post.content) for post in board_posts.posts_since(since_id)]
+
+
+def build_board(rows, full_sync_time, previous=None):
+    # rows in id order, from the board store
+    posts = [Post(id, parent, time, timestamp, sys.intern(content)) for id, parent, time, timestamp, content in rows]
+    if previous is not None:
+        return add_posts(previous, posts)
+    return make_board(posts, full_sync_time)
+
+
+# boards are shared between the gunicorn workers on a host through a sqlite file,
+# BOARD_CACHE_PATH= (empty) keeps every worker to itself
+board_cache_path = os.environ.get('BOARD_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'cyberland-boards-v3.sqlite'))
+board_cache = BoardCache(store=SqliteStore(board_cache_path, post_rows, build_board) if board_cache_path else None)
+
+
+def prepare_post(raw):
+    try:
+        parent = int(raw['replyTo'])
+    except:
+        parent = 0
+    content = raw['content']
+    with timed('escape'):
+        content = str(escape(content))
+    with timed('transcode'):
+        content = convert_ansi_to_html(content)
+    with timed('links'):
+        content = make_urls_clickable(content)
+    # content = content.replace('\r\n', '\n').replace('\n', '<br>')
+    # the same text gets posted over and over, keep one copy of it
+    content = sys.intern(content)
+    return Post(int(raw['id']), parent, raw.get('time'), parse_time(raw.get('time')), content)
 
 
-def get_posts_for_board_simple(backend, board_name):
-    flat_posts = get_all_posts(backend.url, board_name)
+def parse_time(value):
+    # backends don't agree on a time format, anything we can't read sorts last
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def prepare_posts(raw_posts):
+    return [prepare_post(raw) for raw in raw_posts]
+
+
+async def get_posts_for_board_simple(backend, board_name, previous=None):
+    now = time.time()
+    # a board from the store (after a restart, say) first gets only what's new so the
+    # page is up right away, an overdue full sync follows with the next refresh
+    if previous and (previous.restored or now - previous.full_sync_time < FULL_SYNC_SECS):
+        new_posts = await get_new_posts(backend.url, board_name, previous.max_id)
+        if new_posts is not None:
+            return await blocking(merge_posts, previous, new_posts)
+
+    # full fetch, also the only way we notice deleted posts
+    flat_posts = []
+    batch = []
+    raw_posts = await iter_all_posts(backend.url, board_name)
+    try:
+        while True:
+            # reading and parsing the body, the posts come in as it's read
+            with timed('download'):
+                try:
+                    raw = await raw_posts.__anext__()
+                except StopAsyncIteration:
+                    break
+            batch.append(raw)
+            if len(batch) >= PREPARE_BATCH:
+                flat_posts += await blocking(prepare_posts, batch)
+                batch = []
+    finally:
+        await raw_posts.aclose()
+    flat_posts += await blocking(prepare_posts, batch)
+    return await blocking(make_board, flat_posts, now)
+
+
+def make_board(flat_posts, full_sync_time):
     posts = []
     posts_lookup = { }
     for post in flat_posts:
-        post['id'] = int(post['id'])
-        try:
-            post['replyTo'] = int(post['replyTo'])
-        except:
-            post['replyTo'] = 0
-        post['replies'] = []
-        posts_lookup[post['id']] = post
-        content = post['content']
-        content = str(escape(content))
-        content = convert_ansi_to_html(content)
-        content = make_urls_clickable(content)
-        # content = content.replace('\r\n', '\n').replace('\n', '<br>')
-        post['content'] = content
+        posts_lookup[post.id] = post
 
+    # sort_posts turns these into the replies tuples
+    replies = {}
     for post in flat_posts:
-        if post['replyTo'] == 0:
+        if post.parent == 0:
             posts.append(post)
         else:
-            if post['replyTo'] in posts_lookup:
-                posts_lookup[post['replyTo']]['replies'].append(post)
+            if post.parent in posts_lookup:
+                replies.setdefault(post.parent, []).append(post)
             else:
-                print(f'missing post {post["replyTo"]}')
+                print(f'missing post {post.parent}')
+    for id, post_replies in replies.items():
+        posts_lookup[id].replies = post_replies
     
     
     #posts = sort_ops_by_bump(posts)
     #sort_replies(posts)
-    posts = sort_posts(posts)
+    with timed('sort'):
+        posts = sort_posts(posts)
 
 
-    return posts
-    
+    return BoardPosts(posts, posts_lookup, full_sync_time)
+
+
+def merge_posts(previous, new_posts):
+    if not new_posts and not previous.restored:
+        return previous
+    # oldest first so a reply to a post in the same batch finds its parent
+    new_posts = sorted(new_posts, key=lambda p: int(p['id']))
+    return add_posts(previous, [prepare_post(raw) for raw in new_posts if int(raw['id']) not in previous.posts_lookup])
+
+
+def add_posts(previous, new_posts):
+    # a new board of previous plus these posts, oldest first
+    posts = previous.posts
+    posts_lookup = dict(previous.posts_lookup)
+    for post in new_posts:
+        if post.id in posts_lookup:
+            continue
+        posts_lookup[post.id] = post
+        with timed('sort'):
+            posts = add_post(posts, posts_lookup, post)
+    return BoardPosts(posts, posts_lookup, previous.full_sync_time)
+
+
+def board_loader(backend, board_name):
+    key = backend.name + ':' + board_name
+    async def load(previous):
+        with Stages(key):
+            board_posts = await get_posts_for_board_simple(backend, board_name, previous)
+            # new posts go into the search index while we're off the request path anyway
+            with timed('index'):
+                await blocking(search_index.update, key, board_posts)
+        return board_posts
+    return load
+
+
+def board_ttl(backend, board_name):
+    board = board_by_name(backend, board_name)
+    return board.cache_ttl if board else CACHE_STALE_SECS
+
 
+def get_board_cacheable(backend, board_name):
+    key = backend.name + ':' + board_name
+    entry = board_cache.get(key, board_loader(backend, board_name), board_ttl(backend, board_name))
+    return entry.board
 
-def get_posts_cacheable(backend, board_name):
-    CACHE_STALE_SECS = 10
-    with cache_lock:
-        key = backend.name + ':' + board_name
-        if not key in cache or time.time() - cache[key].time > CACHE_STALE_SECS:
-            posts = get_posts_for_board_simple(backend, board_name)
-            cache[key] = CacheEntry(posts=posts, time=time.time())
-        return cache[key].posts
+
+async def get_board_async(backend, board_name):
+    key = backend.name + ':' + board_name
+    entry = await board_cache.get_async(key, board_loader(backend, board_name), board_ttl(backend, board_name))
+    return entry.board
+
+
+async def warm_board(backend, board):
+    key = backend.name + ':' + board.name
+    entry = await asyncio.wrap_future(board_cache.refresh(key, board_loader(backend, board.name), board.cache_ttl))
+    return entry.board.max_id
 
 class Backend(object):
     def __init__(self, name, url, title, boards):
@@ -202,12 +421,13 @@ class Backend(object):
         self.boards = boards
 
 class Board(object):
-    def __init__(self, name, title, images=False, char_limit=80000, hidden=False):
+    def __init__(self, name, title, images=False, char_limit=80000, hidden=False, cache_ttl=CACHE_STALE_SECS):
         self.name = name
         self.title = title
         self.images = images
         self.char_limit = char_limit
         self.hidden = hidden
+        self.cache_ttl = cache_ttl
 
 
 backends = [
@@ -219,6 +439,19 @@ backends = [
         [Board('t', 'technology'), Board('n', 'news'), Board('o', 'off-topic'), Board('i', 'image', images=True), Board('c', 'client tests')]),
 ]
 
+for backend in backends:
+    for board in backend.boards:
+        cache_warmer.add(backend.name + ':' + board.name,
+            lambda backend=backend, board=board: warm_board(backend, board))
+
+
+def start_warmer():
+    # called by the process that serves, never on import: gunicorn.conf.py does it
+    # in each worker, image workers and scripts importing the app don't warm
+    # anything. WARM_CACHE=0 turns it off
+    if os.environ.get('WARM_CACHE', '1') == '1':
+        cache_warmer.start()
+
 def board_by_name(backend, name):
     if not backend:
         return None
@@ -231,10 +464,201 @@ def backend_by_name(name):
         if backend.name == name:
             return backend
 
+def aggregate_boards():
+    # every board some backend shows, titled after the first one that has it
+    boards = {}
+    for backend in backends:
+        for board in backend.boards:
+            if not board.hidden:
+                boards.setdefault(board.name, board)
+    return list(boards.values())
+
 def make_urls_clickable(text):
     text = re.sub(r'(https?://\w+\.\w+\S*)', r'<a href="\1" target="_blank">\1</a>', text)
     return text
 
+STREAM_CHUNK_SIZE = 16 * 1024
+THREADS_PER_PAGE = 20
+THREAD_PREVIEW_POSTS = 20
+MAX_UPDATE_POSTS = 200
+IMAGE_MODES = ['auto'] + MODES
+SSE_PING_SECS = 15
+# streams end now and then so the slots go round, the browser reconnects
+SSE_STREAM_SECS = 300
+SSE_RETRY_MS = 10000
+SEARCH_RESULTS = 50
+# yielded by a page renderer to send whatever is buffered right away
+FLUSH = None
+
+
+def buffered(chunks):
+    # renderers yield one small string per tag, send them in bigger pieces
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        if chunk is not FLUSH:
+            buffer.append(chunk)
+            size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE or (chunk is FLUSH and buffer):
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def render_repeating(same_posts):
+    return f'<div class="post" style="color:green">({same_posts}x repeating)</div>'
+
+
+def render_post_head(post):
+    # everything of a post up to its replies, the caller closes both divs
+    parts = ['<div class="post">', '<pre class="content">']
+    parts.append(f'<a href="javascript:quote({post.id})" id="p{post.id}">#{post.id}</a> <i>{post.time}</i><br>')
+    if post.content.count('<br>') >= 100:
+        parts.append(f'<div class="post" style="color:green">(post hidden, over 100 lines)</div>')
+    else:
+        parts.append(post.content)
+    parts.append('</pre>')
+    parts.append('<div class="replies">')
+    return ''.join(parts)
+
+
+def collapse_repeats(posts):
+    # yields the posts to render, a run of identical leaf posts after the first
+    # one is replaced by its length
+    prev_post = None
+    same_posts = 0
+    for post in posts:
+        if prev_post and prev_post.content == post.content and not post.replies:
+            same_posts += 1
+            continue
+        if same_posts > 0:
+            yield same_posts
+            same_posts = 0
+        yield post
+        prev_post = post
+    if same_posts > 0:
+        yield same_posts
+
+
+def render_posts(posts, render_head=render_post_head):
+    # an explicit stack instead of recursion, reply chains can be thousands deep
+    stack = [collapse_repeats(posts)]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+            if stack:
+                yield '</div></div>'
+        elif isinstance(item, int):
+            yield render_repeating(item)
+        else:
+            yield render_head(item)
+            stack.append(collapse_repeats(item.replies))
+
+
+def count_replies(post):
+    count = 0
+    stack = list(post.replies)
+    while stack:
+        reply = stack.pop()
+        count += 1
+        stack.extend(reply.replies)
+    return count
+
+
+def render_post_head_cached(prefix, post):
+    key = (prefix, post.id, hash(post.content))
+    html = fragment_cache.get('post', key)
+    if html is None:
+        html = render_post_head(post)
+        fragment_cache.put('post', key, html)
+    return html
+
+
+def thread_version(board_posts, post):
+    # a thread's html only changes when it gets a new reply (its bump id moves)
+    # or when a full sync may have dropped deleted posts from it
+    return (post.bump, board_posts.full_sync_time)
+
+
+def render_replies(prefix, board_posts, post):
+    key = (prefix, post.id)
+    version = thread_version(board_posts, post)
+    html = fragment_cache.get('replies', key, version)
+    if html is None:
+        html = ''.join(render_posts(post.replies, lambda reply: render_post_head_cached(prefix, reply)))
+        fragment_cache.put('replies', key, html, version)
+    return html
+
+
+def render_thread(prefix, board_posts, post):
+    # on board pages big threads only show the op, the replies are fetched
+    # when someone opens them
+    key = (prefix, post.id)
+    version = thread_version(board_posts, post)
+    html = fragment_cache.get('thread', key, version)
+    if html is None:
+        replies = count_replies(post)
+        if replies > THREAD_PREVIEW_POSTS:
+            backend_name, board_name = prefix.split(':', 1)
+            url = f'/{backend_name}/{board_name}/thread/{post.id}'
+            replies_html = f'<a href="{url}" onclick="loadReplies(this); return false">[show {replies} replies]</a>'
+        else:
+            replies_html = render_replies(prefix, board_posts, post)
+        html = render_post_head_cached(prefix, post) + replies_html + '</div></div>'
+        fragment_cache.put('thread', key, html, version)
+    return html
+
+
+def render_threads(backend, board, board_posts, offset=0):
+    prefix = backend.name + ':' + board.name
+    for item in collapse_repeats(board_posts.posts[offset:offset + THREADS_PER_PAGE]):
+        if isinstance(item, int):
+            yield render_repeating(item)
+        else:
+            with timed('render'):
+                html = render_thread(prefix, board_posts, item)
+            yield html
+
+
+def render_page_menu(url, threads, offset):
+    pages = max((threads + THREADS_PER_PAGE - 1) // THREADS_PER_PAGE, 1)
+    current = offset // THREADS_PER_PAGE + 1
+    page_menu = []
+    for page in range(1, pages + 1):
+        if page == current:
+            page_menu.append(f'<a class="active" href="{url}?page={page}">{page}</a>')
+        elif page in (1, pages) or abs(page - current) <= 5:
+            page_menu.append(f'<a href="{url}?page={page}">{page}</a>')
+    return '<div class="menu">pages: [' + '] ['.join(page_menu) + ']</div>'
+
+
+def render_posts_div(backend, board, board_posts, page):
+    # what updatePosts() needs to ask for only the posts it hasn't seen
+    updates_url = f'/{backend.name}/{board.name}/updates'
+    events_url = f'/{backend.name}/{board.name}/events'
+    return f'<div id="posts" data-max-id="{board_posts.max_id}" data-page="{page}" data-updates="{updates_url}" data-events="{events_url}">'
+
+
+def thread_id_of(posts_lookup, post):
+    seen = set()
+    while post.parent != 0 and post.parent in posts_lookup and post.id not in seen:
+        seen.add(post.id)
+        post = posts_lookup[post.parent]
+    return post.id
+
+
+def get_offset(args):
+    try:
+        if 'offset' in args:
+            return max(int(args['offset']), 0)
+        return max(int(args.get('page', 1)) - 1, 0) * THREADS_PER_PAGE
+    except ValueError:
+        return 0
+
+
 app = Flask(__name__)
 app.secret_key = b'_5#y2L"Ffghgfhgf4Q8z\n\xec]/'
 
@@ -243,39 +667,77 @@ app.secret_key = b'_5#y2L"Ffghgfhgf4Q8z\n\xec]/'
 @app.route('/<backend_name>/')
 @app.route('/<backend_name>/<name>')
 @app.route('/<backend_name>/<name>/')
-def route_board(backend_name=None, name=None):
+@app.route('/<backend_name>/<name>/thread/<int:thread_id>')
+def route_board(backend_name=None, name=None, thread_id=None):
     active_backend = backend_by_name(backend_name)
     active_board = board_by_name(active_backend, name)
 
-    cookies = []
-    def respond_with_page():
-        resp = make_response(page)
-        for cookie in cookies:
-            resp.set_cookie(cookie[0], cookie[1])
-        return resp
-
-    if request.args.get('dismissMotd') == '1':
-        cookies.append(('motdDismissed', str(time.time())))
-
-    page = ''
-    page += '''
+    # everything that needs the request (and the flashed messages, which live in
+    # the session cookie) is read before the body starts streaming
+    dismiss_motd = request.args.get('dismissMotd') == '1'
+    show_motd = "motdDismissed" not in request.cookies and not dismiss_motd
+    messages = get_flashed_messages()
+    offset = get_offset(request.args)
+    resp = None
+    if active_board and not messages:
+        resp = cached_board_page(active_backend, active_board, show_motd, offset, thread_id)
+    if resp is None:
+        page = render_board(active_backend, active_board, show_motd, messages, offset=offset, thread_id=thread_id)
+        resp = Response(buffered(page))
+    if dismiss_motd:
+        resp.set_cookie('motdDismissed', str(time.time()))
+    return resp
+
+
+def cached_board_page(backend, board, show_motd, offset, thread_id):
+    # a board that's already loaded is rendered (and compressed) once per version
+    # and the etag lets a client that has it skip the body altogether. None when
+    # the board has to be loaded first, that page is streamed instead
+    key = backend.name + ':' + board.name
+    cached = board_cache.cached(key)
+    if cached is None:
+        return None
+    try:
+        board_posts = get_board_cacheable(backend, board.name)
+    except BackendError:
+        return None
+    _, generation = cached
+    page = offset if thread_id is None else f't{thread_id}'
+    page_key = (key, page, show_motd)
+    etag = f'{board_posts.version()}-{generation}-{page}-{int(show_motd)}'
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        encoding = request.accept_encodings.best_match(encodings(), default='identity')
+        def render():
+            chunks = render_board(backend, board, show_motd, [], offset=offset, thread_id=thread_id, board_posts=board_posts)
+            return ''.join(chunk for chunk in chunks if chunk is not FLUSH)
+        with timed('page'):
+            resp = Response(page_cache.get(page_key, etag, encoding, render))
+        if encoding != 'identity':
+            resp.headers['Content-Encoding'] = encoding
+    # weak, the compressed bodies are the same page
+    resp.set_etag(etag, weak=True)
+    resp.headers['Vary'] = 'Accept-Encoding, Cookie'
+    # check back every time, it's a 304 when nothing changed
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def render_page_head(title):
+    yield '''
     <html>
     <head>
     '''
-    if active_board:
-        page += f'<title>/{active_board.name}/ - {active_board.title} ({active_backend.title})</title>'
-    elif active_backend:
-        page += f'<title>{active_backend.title}</title>'
-    else:
-        page += f'<title>cyberland</title>'
+    yield f'<title>{title}</title>'
 
-    page += '''
+    yield '''
     <link rel="apple-touch-icon" sizes="180x180" href="/static/apple-touch-icon.png">
     <link rel="icon" type="image/png" sizes="32x32" href="/static/favicon-32x32.png">
     <link rel="icon" type="image/png" sizes="16x16" href="/static/favicon-16x16.png">
     <link rel="manifest" href="/static/site.webmanifest">
     '''
-    page += '''
+    yield '''
     <style>
     body {
         color: lime;
@@ -343,36 +805,47 @@ def route_board(backend_name=None, name=None):
     }
     </style>
     '''
-    page += '''
+    yield '''
     </head>
     <body>
     '''
+
+
+def render_menus(active_backend, active_board, aggregate=False):
     backend_menu = []
     for backend in backends:
         if backend == active_backend:
             backend_menu.append(f'<a class="active" href="/{backend.name}/">{backend.title}</a></b>')
         else:
             backend_menu.append(f'<a href="/{backend.name}/">{backend.title}</a>')
-    page += '<div class="menu">'
-    page += 'backends: '
-    page += '[' + '] ['.join(backend_menu) + ']'
-    page += '</div>'
-    if active_backend:
+    if aggregate:
+        backend_menu.append('<a class="active" href="/all/">all</a>')
+    else:
+        backend_menu.append('<a href="/all/">all</a>')
+    yield '<div class="menu">'
+    yield 'backends: '
+    yield '[' + '] ['.join(backend_menu) + ']'
+    yield '</div>'
+    if active_backend or aggregate:
+        backend_name = 'all' if aggregate else active_backend.name
+        boards = aggregate_boards() if aggregate else active_backend.boards
         board_menu = []
-        for board in active_backend.boards:
+        for board in boards:
             if board == active_board:
-                board_menu.append(f'<a class="active" href="/{active_backend.name}/{board.name}/">/{board.name}/ - {board.title}</a></b>')
+                board_menu.append(f'<a class="active" href="/{backend_name}/{board.name}/">/{board.name}/ - {board.title}</a></b>')
             elif not board.hidden:
-                board_menu.append(f'<a href="/{active_backend.name}/{board.name}/">/{board.name}/ - {board.title}</a>')
-        page += '<div class="menu">'
-        page += 'boards: '
-        page += '[' + '] ['.join(board_menu) + ']'
-        page += '</div>'
+                board_menu.append(f'<a href="/{backend_name}/{board.name}/">/{board.name}/ - {board.title}</a>')
+        yield '<div class="menu">'
+        yield 'boards: '
+        yield '[' + '] ['.join(board_menu) + ']'
+        yield '</div>'
     
-    page += '<br>'
+    yield '<br>'
 
-    if "motdDismissed" not in request.cookies and request.args.get('dismissMotd') != '1':
-        page += '''
+
+def render_motd(show_motd):
+    if show_motd:
+        yield '''
 <pre style="border: 1px dotted lime; padding: 10px; color: lime">
 A NOTE FROM THE DEVS
 
@@ -393,42 +866,155 @@ https://github.com/cyberland-digital/cyberland-protocol/blob/master/protocol.md
 </pre>
 
 '''
-    
+
+
+def render_page_end():
+    yield r'''
+    <script type="text/javascript">
+    function quote(id) {
+        let textarea = document.querySelector("textarea");
+        let lines = textarea.value.split("\n");
+        if (lines[0].match(/>>\d+/))
+            lines.shift();
+        lines.unshift(">>" + id);
+        textarea.value = lines.join("\n");
+    }
+
+    async function updatePosts() {
+        let button = document.getElementById('updatePosts');
+        let posts = document.getElementById('posts');
+        button.innerHTML = '...';
+        let req = await fetch(posts.dataset.updates + '?since=' + posts.dataset.maxId);
+        if (req.status == 200)
+            applyUpdate(posts, await req.json());
+        button.innerHTML = '[Update posts]';
+    }
+
+    function applyUpdate(posts, update) {
+        if (update.truncated) {
+            window.location.reload();
+            return;
+        }
+        for (let post of update.posts)
+            insertPost(posts, post);
+        posts.dataset.maxId = Math.max(posts.dataset.maxId, update.max_id);
+    }
+
+    function followPosts() {
+        let posts = document.getElementById('posts');
+        if (!posts || !window.EventSource)
+            return;
+        let events = new EventSource(posts.dataset.events + '?since=' + posts.dataset.maxId);
+        events.addEventListener('posts', function(e) {
+            applyUpdate(posts, JSON.parse(e.data));
+        });
+    }
+    followPosts();
+
+    function insertPost(posts, post) {
+        if (document.getElementById('p' + post.id))
+            return;
+        let container = posts;
+        if (post.parent != 0) {
+            let parent = document.getElementById('p' + post.parent);
+            if (!parent)
+                return;
+            container = parent.closest('.post').querySelector('.replies');
+        } else if (posts.dataset.page != '1') {
+            return;
+        }
+        let div = document.createElement('div');
+        div.innerHTML = post.html;
+        container.insertBefore(div.firstChild, container.firstChild);
+        // the reply bumped its thread to the top
+        let thread = document.getElementById('p' + post.thread);
+        if (thread && posts.dataset.page == '1') {
+            thread = thread.closest('.post');
+            if (thread.parentNode == posts)
+                posts.insertBefore(thread, posts.firstChild);
+        }
+    }
+
+    async function loadReplies(link) {
+        let replies = link.parentNode;
+        link.innerHTML = '...';
+        let req = await fetch(link.href + '/replies');
+        if (req.ok)
+            replies.innerHTML = await req.text();
+        else
+            link.innerHTML = '[failed to load replies]';
+    }
+    </script>
+    '''
+    yield '</body>'
+    yield '</html>'
+
+
+def render_board(active_backend, active_board, show_motd, messages, offset=0, thread_id=None, board_posts=None):
+    if active_board:
+        title = f'/{active_board.name}/ - {active_board.title} ({active_backend.title})'
+    elif active_backend:
+        title = active_backend.title
+    else:
+        title = 'cyberland'
+    yield from render_page_head(title)
+    yield from render_menus(active_backend, active_board)
+    yield from render_motd(show_motd)
+
     if not active_backend:
-        page += '<h1>select backend</h1>'
+        yield '<h1>select backend</h1>'
     if active_backend and not active_board:
-        page += '<h1>select board</h1>'
+        yield '<h1>select board</h1>'
 
-    for message in get_flashed_messages():
-        page += f'<div><h3>{message}</h3><br>'
+    for message in messages:
+        yield f'<div><h3>{message}</h3><br>'
 
     if not active_board or not active_backend:
-        return respond_with_page()
-
-    page += f'<h2>/{active_board.name}/ - {active_board.title} @ {active_backend.title}</h2>'
+        return
+
+    yield f'<h2>/{active_board.name}/ - {active_board.title} @ {active_backend.title}</h2>'
+    yield f'''
+    <form action="/search">
+    <input type="hidden" name="backend" value="{active_backend.name}">
+    <input type="hidden" name="board" value="{active_board.name}">
+    <input name="q"> <input type="submit" value="search /{active_board.name}/">
+    </form>
+    '''
+    # get the page going before we possibly wait on the backend
+    yield FLUSH
 
     try:
-        posts = get_posts_cacheable(active_backend, name)
+        if board_posts is None:
+            board_posts = get_board_cacheable(active_backend, active_board.name)
     except BackendError as error:
-        posts = []
-        page += f'<h2>backend failed ({error.response.status_code})</h2>'
-        page += '<div style="border: 1px solid lime; padding: 10px">'
-        page += error.response.text
-        page += '</div>'
-        return respond_with_page()
+        yield f'<h2>backend failed ({error.status})</h2>'
+        if error.text is not None:
+            yield '<div style="border: 1px solid lime; padding: 10px">'
+            yield error.text
+            yield '</div>'
+        return
 
 
     if active_board.images:
-        page += f'''
+        yield f'''
         <form method="post" enctype="multipart/form-data" action="/{active_backend.name}/{active_board.name}/post">
         <textarea name="content"></textarea><br>
         <label for="file">Attach image: </label><input id="file" type="file" name="file" accept="image/png, image/jpeg"><br>
+        <label for="mode">Image mode: </label><select id="mode" name="mode">
+        <option value="auto">auto (most pixels)</option>
+        <option value="bg24">blocks, truecolor</option>
+        <option value="half24">half blocks, truecolor</option>
+        <option value="bg256">blocks, 256 colors</option>
+        <option value="half256">half blocks, 256 colors</option>
+        </select>
+        <label><input type="checkbox" name="dither" value="1"> dither</label><br>
+        <label><input type="checkbox" name="async" value="1"> convert in the background, post when done</label><br>
         <input type="submit">
         </form>
         <br>
         '''
     else:
-        page += f'''
+        yield f'''
         <form method="post" action="/{active_backend.name}/{active_board.name}/post">
         <textarea name="content"></textarea><br>
         <input type="submit">
@@ -437,77 +1023,408 @@ https://github.com/cyberland-digital/cyberland-protocol/blob/master/protocol.md
         '''
 
 
-    page += '<a id="updatePosts" href="javascript:updatePosts()">[Update posts]</a><br><br>'
-    page += '<div id="posts">'
+    yield '<a id="updatePosts" href="javascript:updatePosts()">[Update posts]</a><br><br>'
+    prefix = active_backend.name + ':' + active_board.name
+    if thread_id is not None:
+        yield f'<a href="/{active_backend.name}/{active_board.name}/">[back to /{active_board.name}/]</a><br><br>'
+        yield render_posts_div(active_backend, active_board, board_posts, 'thread')
+        post = board_posts.posts_lookup.get(thread_id)
+        if post:
+            with timed('render'):
+                html = render_post_head_cached(prefix, post) + render_replies(prefix, board_posts, post)
+            yield html
+            yield '</div></div>'
+        else:
+            yield f'<h3>thread #{thread_id} not found</h3>'
+        yield "</div>"
+    else:
+        yield render_posts_div(active_backend, active_board, board_posts, offset // THREADS_PER_PAGE + 1)
+        yield from render_threads(active_backend, active_board, board_posts, offset)
+        yield "</div>"
+        yield '<br>'
+        yield render_page_menu(f'/{active_backend.name}/{active_board.name}/', len(board_posts.posts), offset)
+        
 
-    def render_collapse(posts):
-        nonlocal page
-        prev_post = None
-        same_posts = 0
-        for post in posts:
-            if prev_post and prev_post['content'] == post['content'] and not post['replies']:
-                same_posts += 1
-                continue
-            if same_posts > 0:
-                page += f'<div class="post" style="color:green">({same_posts}x repeating)</div>'
-            render_post(post)
-            prev_post = post
-            same_posts = 0
-        if same_posts > 0:
-            page += f'<div class="post" style="color:green">({same_posts}x repeating)</div>'
-    
-    def render_post(post):
-        nonlocal page
-        page += '<div class="post">'
-        page += '<pre class="content">'
-        page += f'<a href="javascript:quote({post["id"]})" id="p{post["id"]}">#{post["id"]}</a> <i>{post["time"]}</i><br>'
-        if len(post['content'].split('<br>')) > 100:
-            page += f'<div class="post" style="color:green">(post hidden, over 100 lines)</div>'
-        else:    
-            page += post['content']
-        page += '</pre>'
-        page += '<div class="replies">'
-        if 'replies' in post:
-            render_collapse(post['replies'])
-        page += '</div>'
-        page += '</div>'
-    
- 
-    render_collapse(posts)
+    yield from render_page_end()
 
-    page += "</div>"
-        
 
-    page += r'''
-    <script type="text/javascript">
-    function quote(id) {
-        let textarea = document.querySelector("textarea");
-        let lines = textarea.value.split("\n");
-        if (lines[0].match(/>>\d+/))
-            lines.shift();
-        lines.unshift(">>" + id);
-        textarea.value = lines.join("\n");
+def get_boards(boards):
+    # (backend, board) pairs all at once on the event loop, so the wait is the
+    # slowest backend's (up to AGGREGATE_TIMEOUT_SECS) rather than all of them
+    # added up. anything that doesn't make it in time keeps loading into the
+    # cache, in a context of its own so it doesn't report into this request
+    return event_loop.submit(fetch_boards(boards)).result()
+
+
+async def fetch_board(backend, board):
+    # the board or why there isn't one, so a late one has nothing left to raise
+    try:
+        return await get_board_async(backend, board.name), None
+    except BackendError as error:
+        return None, error.status
+    except Exception as error:
+        print(f'{backend.name}/{board.name} failed: {error!r}')
+        return None, type(error).__name__
+
+
+async def fetch_boards(boards):
+    tasks = [asyncio.ensure_future(fetch_board(backend, board)) for backend, board in boards]
+    if tasks:
+        await asyncio.wait(tasks, timeout=AGGREGATE_TIMEOUT_SECS)
+    results = []
+    failures = []
+    for task, (backend, board) in zip(tasks, boards):
+        if not task.done():
+            failures.append((backend, board, 'timed out'))
+            continue
+        board_posts, failure = task.result()
+        if failure is None:
+            results.append((backend, board, board_posts))
+        else:
+            failures.append((backend, board, failure))
+    return results, failures
+
+
+def get_aggregate(board_name):
+    return get_boards([(backend, board_by_name(backend, board_name)) for backend in backends if board_by_name(backend, board_name)])
+
+
+def bump_time(board_posts, post):
+    return board_posts.posts_lookup.get(post.bump, post).timestamp
+
+
+def render_aggregate(active_board, show_motd, messages, offset=0):
+    if active_board:
+        title = f'/{active_board.name}/ - {active_board.title} (all backends)'
+    else:
+        title = 'all backends'
+    yield from render_page_head(title)
+    yield from render_menus(None, active_board, aggregate=True)
+    yield from render_motd(show_motd)
+
+    if not active_board:
+        yield '<h1>select board</h1>'
+
+    for message in messages:
+        yield f'<div><h3>{message}</h3><br>'
+
+    if not active_board:
+        return
+
+    yield f'<h2>/{active_board.name}/ - {active_board.title} @ all backends</h2>'
+    yield FLUSH
+
+    results, failures = get_aggregate(active_board.name)
+    for backend, _, status in failures:
+        yield f'<h3>{backend.title} failed ({status}), its threads are missing</h3>'
+
+    # every backend's threads are already in bump order, merging only has to
+    # walk as far as the page being shown
+    threads = heapq.merge(
+        *[[(backend, board_posts, post) for post in board_posts.posts] for backend, _, board_posts in results],
+        key=lambda item: bump_time(item[1], item[2]), reverse=True)
+    yield '<div id="aggregate">'
+    for backend, board_posts, post in itertools.islice(threads, offset, offset + THREADS_PER_PAGE):
+        url = f'/{backend.name}/{active_board.name}/thread/{post.id}'
+        yield f'<div class="origin">[<a href="{url}">{backend.title}</a>]</div>'
+        with timed('render'):
+            html = render_thread(backend.name + ':' + active_board.name, board_posts, post)
+        yield html
+    yield '</div>'
+    yield '<br>'
+    yield render_page_menu(f'/all/{active_board.name}/', sum(len(board_posts.posts) for _, _, board_posts in results), offset)
+
+    yield from render_page_end()
+
+
+@app.route('/all')
+@app.route('/all/')
+@app.route('/all/<name>')
+@app.route('/all/<name>/')
+def route_aggregate(name=None):
+    active_board = None
+    for board in aggregate_boards():
+        if board.name == name:
+            active_board = board
+
+    dismiss_motd = request.args.get('dismissMotd') == '1'
+    show_motd = "motdDismissed" not in request.cookies and not dismiss_motd
+    page = render_aggregate(active_board, show_motd, get_flashed_messages(), offset=get_offset(request.args))
+    resp = Response(buffered(page))
+    if dismiss_motd:
+        resp.set_cookie('motdDismissed', str(time.time()))
+    return resp
+
+
+def search_boards(backend_name, board_name):
+    boards = []
+    for backend in backends:
+        if backend_name and backend.name != backend_name:
+            continue
+        for board in backend.boards:
+            if board.name == board_name or (not board_name and not board.hidden):
+                boards.append((backend, board))
+    return boards
+
+
+def render_search(query, backend_name, board_name):
+    yield from render_page_head(f'search: {escape(query)}' if query else 'search')
+    yield from render_menus(None, None)
+
+    backend_options = ['<option value="">all backends</option>']
+    for backend in backends:
+        selected = ' selected' if backend.name == backend_name else ''
+        backend_options.append(f'<option value="{backend.name}"{selected}>{backend.title}</option>')
+    board_options = ['<option value="">all boards</option>']
+    for board in aggregate_boards():
+        selected = ' selected' if board.name == board_name else ''
+        board_options.append(f'<option value="{board.name}"{selected}>/{board.name}/ - {board.title}</option>')
+    yield f'''
+    <form action="/search">
+    <input name="q" value="{escape(query)}">
+    <select name="backend">{''.join(backend_options)}</select>
+    <select name="board">{''.join(board_options)}</select>
+    <input type="submit" value="search">
+    </form>
+    <br>
+    '''
+    if not query:
+        return
+    yield FLUSH
+
+    results, failures = get_boards(search_boards(backend_name, board_name))
+    for backend, board, status in failures:
+        yield f'<h3>{backend.title} /{board.name}/ failed ({status}), not searched</h3>'
+
+    matches = []
+    for backend, board, board_posts in results:
+        key = backend.name + ':' + board.name
+        # usually already up to date from loading, boards another worker loaded aren't
+        with timed('search'):
+            search_index.update(key, board_posts)
+            found = search_index.search(key, query)
+        for post_id, score in found.items():
+            post = board_posts.posts_lookup.get(post_id)
+            # the index keeps deleted posts, the board doesn't
+            if post is not None:
+                matches.append((score, post_id, backend, board, board_posts, post))
+    matches.sort(key=lambda match: (match[0], match[1]), reverse=True)
+
+    yield f'<h2>{len(matches)} results for "{escape(query)}"</h2>'
+    for score, post_id, backend, board, board_posts, post in matches[:SEARCH_RESULTS]:
+        thread_id = thread_id_of(board_posts.posts_lookup, post)
+        url = f'/{backend.name}/{board.name}/thread/{thread_id}#p{post.id}'
+        yield f'<div class="origin">[<a href="{url}">{backend.title} /{board.name}/</a>]</div>'
+        with timed('render'):
+            html = render_post_head_cached(backend.name + ':' + board.name, post)
+        yield html + '</div></div>'
+
+    yield from render_page_end()
+
+
+@app.route('/search')
+def route_search():
+    query = request.args.get('q', '').strip()
+    page = render_search(query, request.args.get('backend', ''), request.args.get('board', ''))
+    return Response(buffered(page))
+
+
+@app.route('/<backend_name>/<board_name>/thread/<int:thread_id>/replies')
+def route_replies(backend_name, board_name, thread_id):
+    backend = backend_by_name(backend_name)
+    board = board_by_name(backend, board_name)
+    if not board:
+        return 'no such board', 404
+    try:
+        board_posts = get_board_cacheable(backend, board.name)
+    except BackendError as error:
+        return f'backend failed ({error.status})', 502
+    post = board_posts.posts_lookup.get(thread_id)
+    if not post:
+        return 'no such thread', 404
+    with timed('render'):
+        return render_replies(backend.name + ':' + board.name, board_posts, post)
+
+def board_updates(backend, board, board_posts, since):
+    prefix = backend.name + ':' + board.name
+    new_posts = board_posts.posts_since(since)
+    updates = []
+    for post in new_posts[-MAX_UPDATE_POSTS:]:
+        updates.append({
+            'id': post.id,
+            'parent': post.parent,
+            'thread': thread_id_of(board_posts.posts_lookup, post),
+            'html': render_post_head_cached(prefix, post) + '</div></div>',
+        })
+    return {
+        'max_id': board_posts.max_id,
+        'posts': updates,
+        # the client is too far behind, it should just reload the page
+        'truncated': len(new_posts) > MAX_UPDATE_POSTS,
     }
 
-    async function updatePosts() {
-        let button = document.getElementById('updatePosts');
-        button.innerHTML = '...';
-        let req = await fetch(window.location.href);
-        let text = await req.text();
-        let div = document.createElement('div');
-        div.innerHTML = text;
-        let posts = div.querySelector('\#posts');
-        if (posts) {
-            let oldPosts = document.querySelector('\#posts');
-            oldPosts.parentNode.replaceChild(posts, oldPosts);
-        }
-        button.innerHTML = '[Update posts]';
+@app.route('/<backend_name>/<board_name>/updates')
+def route_updates(backend_name, board_name):
+    backend = backend_by_name(backend_name)
+    board = board_by_name(backend, board_name)
+    if not board:
+        return jsonify({'error': 'no such board'}), 404
+    since = request.args.get('since', 0, type=int)
+    try:
+        board_posts = get_board_cacheable(backend, board.name)
+    except BackendError as error:
+        return jsonify({'error': f'backend failed ({error.status})'}), 502
+    if board_posts.max_id <= since:
+        return '', 304
+
+    return jsonify(board_updates(backend, board, board_posts, since))
+
+def sse_event(update):
+    return f'id: {update["max_id"]}\nevent: posts\ndata: {json.dumps(update)}\n\n'
+
+@app.route('/<backend_name>/<board_name>/events')
+def route_events(backend_name, board_name):
+    backend = backend_by_name(backend_name)
+    board = board_by_name(backend, board_name)
+    if not board:
+        return 'no such board', 404
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    key = backend.name + ':' + board.name
+
+    def poll(since_id):
+        board_posts = get_board_cacheable(backend, board.name)
+        if board_posts.max_id <= since_id:
+            return since_id, None
+        return board_posts.max_id, board_updates(backend, board, board_posts, since_id)
+
+    try:
+        board_posts = get_board_cacheable(backend, board.name)
+    except BackendError as error:
+        return f'backend failed ({error.status})', 502
+    # the shared poller starts from the board as it is now, not from whatever
+    # page the first subscriber happened to have open
+    subscription = live_updates.subscribe(key, poll, board.cache_ttl, board_posts.max_id)
+    if subscription is None:
+        # no reconnecting on a 204, the page still has [Update posts]
+        return '', 204
+    poller, subscriber = subscription
+    # catch up from where the client was, then follow the shared poller
+    last_id = max(since, board_posts.max_id)
+    update = board_updates(backend, board, board_posts, since) if board_posts.max_id > since else None
+
+    def events():
+        yield f'retry: {SSE_RETRY_MS}\n\n'
+        if update is not None:
+            yield sse_event(update)
+        else:
+            yield ': ping\n\n'
+        current_id = last_id
+        deadline = time.time() + SSE_STREAM_SECS
+        while time.time() < deadline:
+            try:
+                next_update = subscriber.get(timeout=SSE_PING_SECS)
+            except queue.Empty:
+                # keeps proxies (and heroku's 55s idle timeout) from dropping us
+                yield ': ping\n\n'
+                continue
+            if next_update['max_id'] > current_id:
+                yield sse_event(next_update)
+                current_id = next_update['max_id']
+
+    resp = Response(events(), mimetype='text/event-stream')
+    # also when the body never got going
+    resp.call_on_close(lambda: live_updates.unsubscribe(poller, subscriber))
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+def request_board():
+    args = request.view_args or {}
+    name = args.get('board_name') or args.get('name')
+    if request.endpoint == 'route_aggregate':
+        return f'all:{name}' if any(board.name == name for board in aggregate_boards()) else '-'
+    backend = backend_by_name(args.get('backend_name'))
+    board = board_by_name(backend, name)
+    return f'{backend.name}:{board.name}' if board else '-'
+
+
+def timed_stream(chunks, stages):
+    # a streamed page does most of its work after the headers are out, so its
+    # timings go at the end of the page instead of into Server-Timing
+    with stages:
+        for chunk in chunks:
+            yield chunk
+    yield f'<!-- Server-Timing: {stages.server_timing()} -->'
+
+
+@app.before_request
+def start_timing():
+    g.stages = Stages(request_board())
+    g.stages.__enter__()
+
+
+@app.after_request
+def finish_timing(response):
+    stages = g.pop('stages', None)
+    if stages is None:
+        return response
+    if not response.is_streamed:
+        stages.__exit__(None, None, None)
+        if stages.times:
+            response.headers['Server-Timing'] = stages.server_timing()
+    else:
+        stages.pause()
+        if response.mimetype == 'text/html':
+            response.response = timed_stream(response.response, stages)
+    return response
+
+
+@app.teardown_request
+def stop_timing(error):
+    # after_request doesn't run for every error
+    stages = g.pop('stages', None)
+    if stages is not None:
+        stages.pause()
+
+
+@app.route('/metrics')
+def route_metrics():
+    histograms = {
+        'cyberland_stage_seconds': stage_series(),
+        'cyberland_upstream_seconds': [([('upstream', url)], latency) for url, latency in sorted(upstream_latencies().items())],
+        'cyberland_image_conversion_seconds': [([], image_jobs.durations)],
     }
-    </script>
-    '''
-    page += '</body>'
-    page += '</html>'
-    return respond_with_page()
+    counters = {}
+    board_stats = board_cache.stats()
+    counters['cyberland_board_cache_total'] = [([('result', result)], board_stats[result]) for result in ['hit', 'stale', 'miss']]
+    fragments = fragment_cache.stats()
+    counters['cyberland_fragment_cache_total'] = (
+        [([('kind', kind), ('result', 'hit')], count) for kind, count in sorted(fragments['hits'].items())] +
+        [([('kind', kind), ('result', 'miss')], count) for kind, count in sorted(fragments['misses'].items())])
+    pages = page_cache.stats()
+    counters['cyberland_page_cache_total'] = [([('result', 'hit')], pages['hits']), ([('result', 'miss')], pages['misses'])]
+    conversions = image_jobs.cache.stats()
+    counters['cyberland_conversion_cache_total'] = [([('result', result)], conversions[key])
+        for result, key in [('hit', 'hits'), ('disk_hit', 'disk_hits'), ('miss', 'misses')]]
+    for name in ['requests', 'errors', 'retries', 'rejected', 'breaker_opened']:
+        counters[f'cyberland_upstream_{name}_total'] = [([('upstream', url)], stats[name]) for url, stats in sorted(upstream_stats().items())]
+    return Response(format_metrics(histograms, counters), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/_stats')
+def route_stats():
+    return jsonify({
+        'boards': board_cache.stats(),
+        'fragments': fragment_cache.stats(),
+        'pages': page_cache.stats(),
+        'live_subscribers': live_updates.stats(),
+        'search': search_index.stats(),
+        'warmer': cache_warmer.stats(),
+        'upstreams': upstream_stats(),
+        'conversions': image_jobs.cache.stats(),
+    })
 
 @app.route('/<backend_name>/<board_name>/post', methods=['POST'])
 def route_post(backend_name, board_name):
@@ -536,6 +1453,11 @@ def route_post(backend_name, board_name):
         reply_to = m.group(1)
         content = lines[1]
 
+    if 'X-Forwarded-For' in request.headers:
+        client_ip = request.headers['X-Forwarded-For'].split(',')[-1].strip()
+    else:
+        client_ip = request.remote_addr
+
     # image upload
     if file:
         if not board.images:
@@ -545,29 +1467,68 @@ def route_post(backend_name, board_name):
         if ext not in ['jpg', 'png']:
             flash('supported file types are .jpg, .png')
             return redirect_to_board()
-        img = Image.open(file.stream)
-        ansi = image_to_ansi(img, board.char_limit)
-        content = ansi + content
-        
-
-    data = { 'content': content, 'replyTo': reply_to }
+        data = file.stream.read(MAX_UPLOAD_BYTES + 1)
+        mode = request.form.get('mode', 'auto')
+        if mode not in IMAGE_MODES:
+            mode = 'auto'
+        dither = bool(request.form.get('dither'))
+        try:
+            if request.form.get('async'):
+                future = image_jobs.submit(data, board.char_limit, mode, dither)
+            else:
+                ansi = image_jobs.convert(data, board.char_limit, mode, dither)
+        except ImageJobError as error:
+            flash(str(error))
+            return redirect_to_board()
+        except Exception as error:
+            print(f'image conversion failed: {error!r}')
+            flash('could not read that image')
+            return redirect_to_board()
 
-    if 'X-Forwarded-For' in request.headers:
-        client_ip = request.headers['X-Forwarded-For'].split(',')[-1].strip()
-    else:
-        client_ip = request.remote_addr
+        if request.form.get('async'):
+            # nobody is waiting for these anymore, a lost post at least leaves a line in the log
+            key = backend.name + ':' + board.name
+            def log_deferred_post(future):
+                try:
+                    r = future.result()
+                except Exception as error:
+                    print(f'deferred post to {key} failed: {error!r}')
+                    return
+                if r.status != 200:
+                    print(f'deferred post to {key} failed? ({r.status})')
+
+            def post_when_converted(future):
+                try:
+                    ansi = future.result()
+                except Exception as error:
+                    print(f'image conversion for a post to {key} failed, post dropped: {error!r}')
+                    return
+                posted = deferred_posts.submit(send_post, backend, board, ansi + content, reply_to, client_ip)
+                posted.add_done_callback(log_deferred_post)
+
+            future.add_done_callback(post_when_converted)
+            flash('converting your image, the post will show up when it is done')
+            return redirect_to_board()
+        content = ansi + content
 
-    r = requests.post(f'{backend.url}/{board.name}/', data=data, headers={'X-Forwarded-For': client_ip})
-    if r.status_code != 200:
-        flash(f'posting failed? ({r.status_code})')
+    try:
+        r = send_post(backend, board, content, reply_to, client_ip)
+    except BackendError as error:
+        flash(f'posting failed ({error.status})')
+        return redirect_to_board()
+    if r.status != 200:
+        flash(f'posting failed? ({r.status})')
     else:
-        flash(f'posting ok ({r.status_code})')
-    with cache_lock:
-        key = backend.name + ':' + board.name
-        if key in cache:
-            del cache[key]
+        flash(f'posting ok ({r.status})')
 
     return redirect_to_board()
 
+def send_post(backend, board, content, reply_to, client_ip):
+    data = { 'content': content, 'replyTo': reply_to }
+    r = event_loop.run(upstream_for(backend.url).post(f'/{board.name}/', data=data, headers={'X-Forwarded-For': client_ip}))
+    board_cache.invalidate(backend.name + ':' + board.name)
+    return r
+
 if __name__ == '__main__':
+    start_warmer()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+
+MAX_CHARS = 32 * 1024 * 1024
+
+
+class FragmentCache(object):
+    # rendered html pieces, LRU-evicted by total size. an entry carries a version
+    # and only counts as a hit when the caller asks for that same version
+    def __init__(self, max_chars=MAX_CHARS):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.chars = 0
+        self.max_chars = max_chars
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, kind, key, version=None):
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end((kind, key))
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+                return entry[1]
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+
+    def put(self, kind, key, html, version=None):
+        with self.lock:
+            old = self.entries.pop((kind, key), None)
+            if old is not None:
+                self.chars -= len(old[1])
+            self.entries[(kind, key)] = (version, html)
+            self.chars += len(html)
+            while self.chars > self.max_chars and self.entries:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.chars -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            kinds = set(self.hits) | set(self.misses)
+            return {
+                'entries': len(self.entries),
+                'chars': self.chars,
+                'hits': {kind: self.hits.get(kind, 0) for kind in kinds},
+                'misses': {kind: self.misses.get(kind, 0) for kind in kinds},
+            }
@@ -0,0 +1,4 @@
+def post_worker_init(worker):
+    # the app is loaded in the worker by now, start warming its cache
+    import flask_app
+    flask_app.start_warmer()
@@ -0,0 +1,147 @@
+import concurrent.futures
+import io
+import math
+import multiprocessing
+import signal
+import threading
+import time
+from PIL import Image
+from image_to_ansi import image_to_ansi
+from conversion_cache import ConversionCache, conversion_key
+from metrics import Histogram
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MAX_WORKERS = 2
+MAX_PENDING = 8
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+MAX_PIXELS = 40 * 1000 * 1000
+JOB_CPU_SECS = 10
+JOB_TIMEOUT_SECS = 30
+
+
+class ImageJobError(Exception):
+    pass
+
+
+class QueueFull(ImageJobError):
+    def __str__(self):
+        return 'too many images are being converted right now, try again in a bit'
+
+
+class ImageTooLarge(ImageJobError):
+    def __str__(self):
+        return 'image is too large'
+
+
+class ConversionTooSlow(ImageJobError):
+    def __str__(self):
+        return 'image took too long to convert'
+
+
+def raise_too_slow(signum, frame):
+    raise ConversionTooSlow()
+
+
+def init_worker():
+    if resource:
+        signal.signal(signal.SIGXCPU, raise_too_slow)
+
+
+def convert_image(data, char_limit, mode, dither):
+    # runs in a worker process. the cpu limit is per process and cumulative,
+    # so every job moves it to what has been used so far plus its allowance
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (math.ceil(usage.ru_utime + usage.ru_stime) + JOB_CPU_SECS, hard))
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.size[0] * img.size[1] > MAX_PIXELS:
+            raise ImageTooLarge()
+        return image_to_ansi(img, char_limit, mode, dither)
+    finally:
+        if resource:
+            resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+class ImageJobs(object):
+    # image conversion happens in a small process pool so a few big uploads
+    # can't take every request thread. at most MAX_PENDING jobs are queued or
+    # running, anything past that is turned away right away
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING, cache=None):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.cache = cache or ConversionCache()
+        self.running = {}
+        self.durations = Histogram()
+
+    def get_executor(self):
+        # started lazily so every gunicorn worker gets its own pool after forking.
+        # forkserver because forking a process that runs threads is asking for trouble
+        with self.lock:
+            if self.executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=context, initializer=init_worker)
+            return self.executor
+
+    def submit(self, data, char_limit, mode='auto', dither=False):
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise ImageTooLarge()
+        key = conversion_key(data, char_limit, mode, dither)
+        ansi = self.cache.get(key)
+        if ansi is not None:
+            future = concurrent.futures.Future()
+            future.set_result(ansi)
+            return future
+        with self.lock:
+            # the same image is already being converted, wait for that one
+            future = self.running.get(key)
+        if future is not None:
+            return future
+
+        if not self.slots.acquire(blocking=False):
+            raise QueueFull()
+        start = time.time()
+        try:
+            future = self.get_executor().submit(convert_image, data, char_limit, mode, dither)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died (out of memory, killed), start over with a fresh pool
+            with self.lock:
+                self.executor = None
+            try:
+                future = self.get_executor().submit(convert_image, data, char_limit, mode, dither)
+            except Exception:
+                self.slots.release()
+                raise
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.running[key] = future
+        future.add_done_callback(lambda future: self.finish(key, future, start))
+        return future
+
+    def finish(self, key, future, start):
+        with self.lock:
+            self.running.pop(key, None)
+        self.slots.release()
+        # includes the wait for a free worker
+        self.durations.observe(time.time() - start)
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+
+    def convert(self, data, char_limit, mode='auto', dither=False):
+        future = self.submit(data, char_limit, mode, dither)
+        try:
+            return future.result(timeout=JOB_TIMEOUT_SECS)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ConversionTooSlow()
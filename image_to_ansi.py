@@ -1,51 +1,171 @@
 from PIL import Image
 import sys
 import math
+import numpy as np
+from ansi import ansi_8bit_colors
 
-def scale_img(img, scale):
-    return img.resize((math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
+MAX_SCALE = 0.15
+ESCAPE = '\033[48;2;{};{};{}m'
+ESCAPE_CHARS = len(ESCAPE.format('', '', ''))
+RESET = '\033[0m\n'
+UPPER_HALF = '▀'
+
+# bg: one cell per pixel of an image squashed to half height, only the background is set
+# half: upper half block, foreground is the top pixel and background the bottom one
+# 24 is truecolor, 256 quantizes to the xterm palette for much shorter escapes
+MODES = ['bg24', 'half24', 'bg256', 'half256']
+
+def hex_rgb(code):
+    color = ansi_8bit_colors[str(code)]
+    return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+
+# the 6x6x6 cube (16-231) and the gray ramp (232-255), so nearest colors
+# can be found per channel instead of against all 256 entries
+CUBE_LEVELS = np.array([hex_rgb(16 + i)[2] for i in range(6)])
+GRAY_LEVELS = np.array([hex_rgb(232 + i)[0] for i in range(24)])
+BAYER = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]]) / 16 - 0.5
+DITHER_SPREAD = 40
+
+def quantize(pixels, dither=False):
+    p = pixels.astype(np.float32)
+    if dither:
+        height, width = p.shape[:2]
+        threshold = np.tile(BAYER, (height // 4 + 1, width // 4 + 1))[:height, :width]
+        p = np.clip(p + threshold[..., None] * DITHER_SPREAD, 0, 255)
+    levels = np.abs(p[..., None] - CUBE_LEVELS).argmin(axis=-1)
+    cube = CUBE_LEVELS[levels]
+    cube_codes = 16 + 36 * levels[..., 0] + 6 * levels[..., 1] + levels[..., 2]
+    grays = np.abs(p.mean(axis=-1)[..., None] - GRAY_LEVELS).argmin(axis=-1)
+    gray = GRAY_LEVELS[grays]
+    cube_error = ((p - cube) ** 2).sum(axis=-1)
+    gray_error = ((p - gray[..., None]) ** 2).sum(axis=-1)
+    return np.where(gray_error < cube_error, 232 + grays, cube_codes)[..., None]
+
+def run_starts(colors):
+    # True where a row starts a new run of one color, each of those costs an escape
+    starts = np.ones(colors.shape[:2], dtype=bool)
+    starts[:, 1:] = np.any(colors[:, 1:] != colors[:, :-1], axis=2)
+    return starts
+
+def fg_starts(fg, glyphs):
+    # the foreground only matters under a half block, spaces in between keep it
+    rows, cols = np.nonzero(glyphs)
+    colors = fg[rows, cols]
+    changes = np.ones(len(rows), dtype=bool)
+    changes[1:] = (rows[1:] != rows[:-1]) | np.any(colors[1:] != colors[:-1], axis=1)
+    starts = np.zeros(glyphs.shape, dtype=bool)
+    starts[rows[changes], cols[changes]] = True
+    return starts
+
+def escape_chars(colors):
+    # '\033[48;2;' + values joined by ';' + 'm', the same length for 38
+    digits = 1 + (colors >= 10) + (colors >= 100)
+    return int(len(colors) * (len('\033[48;2;') + colors.shape[1]) + digits.sum())
+
+class Cells(object):
+    def __init__(self, bg, fg=None, glyphs=None):
+        self.bg = bg
+        self.fg = fg
+        self.glyphs = glyphs
+        self.bg_starts = run_starts(bg)
+        self.fg_starts = fg_starts(fg, glyphs) if fg is not None else None
+
+    def samples(self):
+        height, width = self.bg.shape[:2]
+        return height * width * (2 if self.fg is not None else 1)
+
+    def ansi_length(self):
+        # what len(self.to_ansi()) would be, without building the string
+        height, width = self.bg.shape[:2]
+        length = height * (width + len(RESET)) + escape_chars(self.bg[self.bg_starts])
+        if self.fg is not None:
+            length += escape_chars(self.fg[self.fg_starts])
+        return length
+
+    def to_ansi(self):
+        height, width = self.bg.shape[:2]
+        kind = '2' if self.bg.shape[2] == 3 else '5'
+        bg_escape = '\033[48;' + kind + ';'
+        fg_escape = '\033[38;' + kind + ';'
+        lines = []
+        for y in range(height):
+            bg_row = self.bg[y].tolist()
+            if self.fg is None:
+                events = self.bg_starts[y]
+                text = ' ' * width
+            else:
+                events = self.bg_starts[y] | self.fg_starts[y]
+                text = ''.join(np.where(self.glyphs[y], UPPER_HALF, ' ').tolist())
+                fg_row = self.fg[y].tolist()
+                fg_flags = self.fg_starts[y].tolist()
+            bg_flags = self.bg_starts[y].tolist()
+            xs = np.flatnonzero(events).tolist()
+            parts = []
+            for x, end in zip(xs, xs[1:] + [width]):
+                if self.fg is not None and fg_flags[x]:
+                    parts.append(fg_escape + ';'.join(map(str, fg_row[x])) + 'm')
+                if bg_flags[x]:
+                    parts.append(bg_escape + ';'.join(map(str, bg_row[x])) + 'm')
+                parts.append(text[x:end])
+            lines.append(''.join(parts) + RESET)
+        return ''.join(lines)
+
+def encode_cells(pixels, mode, dither=False):
+    colors = quantize(pixels, dither) if mode.endswith('256') else pixels
+    if not mode.startswith('half'):
+        return Cells(colors)
+    if colors.shape[0] % 2:
+        colors = np.concatenate([colors, colors[-1:]])
+    top = colors[0::2]
+    bottom = colors[1::2]
+    return Cells(bottom, top, np.any(top != bottom, axis=2))
 
 def convert_to_ansi(img):
-    text = ''
-    last_color = None
-    ansi_color = lambda color: f'\033[48;2;{color[0]};{color[1]};{color[2]}m'
-    for y in range(img.size[1]):
-        for x in range(img.size[0]):
-            color = img.getpixel((x, y))
-            if color != last_color:
-                text += ansi_color(color)
-                last_color = color
-            text += ' '
-        text += '\033[0m\n'
-        last_color = None
-    return text
-
-def image_to_ansi(img, char_limit):
-    img = img.convert('RGB')
-    top_scale = 0.15
-    bottom_scale = 0
-    best_scale = None
-    prev_scale = None
-    img = img.resize((img.size[0], math.ceil(img.size[1] / 2)))
-    while True:
-        scale = (top_scale + bottom_scale) / 2
-        scaled_img = scale_img(img, scale)
-        ansi = convert_to_ansi(scaled_img)
-        chars_over = len(ansi) - char_limit
-        if prev_scale == scale:
-            break
-        if chars_over > 0:
-            top_scale = scale
-        elif chars_over < 0:
-            bottom_scale = scale
-            best_scale = scale
-        else:
-            break
-        prev_scale = scale    
+    # the whole image as is, one cell per pixel
+    return Cells(np.asarray(img.convert('RGB'))).to_ansi()
 
-    scaled_img = scale_img(img, best_scale)
-    ansi = convert_to_ansi(scaled_img)
-    return ansi
+def fit(img, char_limit, mode, dither=False):
+    # largest encoding of img in this mode that stays under char_limit
+    if not mode.startswith('half'):
+        img = img.resize((img.size[0], math.ceil(img.size[1] / 2)))
 
+    def cells_for_width(width):
+        scale = width / img.size[0]
+        pixels = np.asarray(img.resize((width, max(math.ceil(img.size[1] * scale), 1))))
+        return encode_cells(pixels, mode, dither)
 
+    # the length grows with the area, so a measurement at the largest size
+    # tells roughly which width fits. bisect from there, measuring each
+    # candidate on the pixel array instead of building its string
+    top = max(math.ceil(img.size[0] * MAX_SCALE), 1)
+    cells = cells_for_width(top)
+    length = cells.ansi_length()
+    if length <= char_limit:
+        return cells
 
+    best = None
+    bottom = 0
+    width = int(top * math.sqrt(char_limit / length))
+    while top - bottom > 1:
+        width = min(max(width, bottom + 1), top - 1)
+        candidate = cells_for_width(width)
+        if candidate.ansi_length() <= char_limit:
+            bottom, best = width, candidate
+        else:
+            top = width
+        width = (bottom + top) // 2
+
+    if best is None:
+        best = cells_for_width(1)
+    return best
+
+def image_to_ansi(img, char_limit, mode='bg24', dither=False):
+    img = img.convert('RGB')
+    if mode == 'auto':
+        # whichever mode gets the most pixels into the budget
+        candidates = [fit(img, char_limit, m, dither) for m in MODES]
+        fitting = [cells for cells in candidates if cells.ansi_length() <= char_limit] or candidates
+        best = max(fitting, key=lambda cells: cells.samples())
+    else:
+        best = fit(img, char_limit, mode, dither)
+    return best.to_ansi()
@@ -0,0 +1,82 @@
+import queue
+import threading
+import time
+
+SUBSCRIBER_QUEUE_SIZE = 100
+MAX_SUBSCRIBERS = 20
+
+
+class BoardPoller(object):
+    # one thread per board asks poll(since_id) for new posts and hands every
+    # update to all subscribers, however many browsers are watching.
+    # poll returns (max_id, update) with update None when nothing is new
+    def __init__(self, registry, key, poll, interval, since_id):
+        self.registry = registry
+        self.key = key
+        self.poll = poll
+        self.interval = interval
+        self.max_id = since_id
+        self.subscribers = set()
+        self.thread = threading.Thread(target=self.run, name=f'poller-{key}', daemon=True)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.registry.lock:
+                if not self.subscribers:
+                    del self.registry.pollers[self.key]
+                    return
+                subscribers = list(self.subscribers)
+            try:
+                max_id, update = self.poll(self.max_id)
+            except Exception as e:
+                print(f'poller {self.key} failed: {e!r}')
+                continue
+            self.max_id = max_id
+            if update is None:
+                continue
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait(update)
+                except queue.Full:
+                    # too slow to keep up, tell it to reload instead of queueing forever
+                    try:
+                        while True:
+                            subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+                    subscriber.put_nowait({'max_id': max_id, 'posts': [], 'truncated': True})
+
+
+class LiveUpdates(object):
+    # every subscriber holds a request thread for as long as it's connected, past
+    # max_subscribers subscribe returns None and the caller should turn it away
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS):
+        self.lock = threading.Lock()
+        self.pollers = {}
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+
+    def subscribe(self, key, poll, interval, since_id):
+        # since_id only matters to a new poller, it should be the board's newest id
+        subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            if self.subscribers >= self.max_subscribers:
+                return None
+            self.subscribers += 1
+            poller = self.pollers.get(key)
+            if poller is None:
+                poller = self.pollers[key] = BoardPoller(self, key, poll, interval, since_id)
+                poller.thread.start()
+            poller.subscribers.add(subscriber)
+        return poller, subscriber
+
+    def unsubscribe(self, poller, subscriber):
+        with self.lock:
+            if subscriber in poller.subscribers:
+                poller.subscribers.discard(subscriber)
+                self.subscribers -= 1
+
+    def stats(self):
+        with self.lock:
+            return {key: len(poller.subscribers) for key, poller in self.pollers.items()}
@@ -0,0 +1,130 @@
+import bisect
+import contextvars
+import threading
+import time
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# what timed() adds to, per thread and per asyncio task
+current_stages = contextvars.ContextVar('stages', default=None)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Stages(object):
+    # collects how long each stage took on this thread or task, e.g. one request or one
+    # board load. nested collections (a load inside a request) hand their times
+    # to the outer one, only the outermost goes into the histograms
+    def __init__(self, board):
+        self.board = board
+        self.times = {}
+        self.outer = None
+
+    def __enter__(self):
+        self.outer = current_stages.get()
+        current_stages.set(self)
+        return self
+
+    def pause(self):
+        # stop collecting on this thread without finishing, a streamed body
+        # picks it up again with another with block
+        current_stages.set(self.outer)
+
+    def __exit__(self, *exc):
+        current_stages.set(self.outer)
+        if self.outer is not None:
+            for stage, secs in self.times.items():
+                self.outer.add(stage, secs)
+        else:
+            self.observe()
+
+    def add(self, stage, secs):
+        self.times[stage] = self.times.get(stage, 0.0) + secs
+
+    def observe(self):
+        for stage, secs in self.times.items():
+            stage_histogram(stage, self.board).observe(secs)
+
+    def server_timing(self):
+        return ', '.join(f'{stage};dur={secs * 1000:.1f}' for stage, secs in self.times.items())
+
+
+class timed(object):
+    # with timed('sort'): ... adds the time to whatever this thread or task is collecting
+    __slots__ = ['stage', 'start']
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stages = current_stages.get()
+        if stages is not None:
+            stages.add(self.stage, time.perf_counter() - self.start)
+
+
+histograms_lock = threading.Lock()
+stage_histograms = {}
+
+
+def stage_histogram(stage, board):
+    with histograms_lock:
+        histogram = stage_histograms.get((stage, board))
+        if histogram is None:
+            histogram = stage_histograms[(stage, board)] = Histogram()
+        return histogram
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+def format_histogram(lines, name, labels, histogram):
+    counts, total, count = histogram.snapshot()
+    cumulative = 0
+    for le, bucket_count in zip(histogram.buckets + ['+Inf'], counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{format_labels(labels + [("le", le)])} {cumulative}')
+    lines.append(f'{name}_sum{format_labels(labels)} {total}')
+    lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+
+def format_metrics(histograms, counters):
+    # prometheus text format. histograms: name -> [(labels, histogram)],
+    # counters: name -> [(labels, value)], labels being (name, value) pairs
+    lines = []
+    for name, series in histograms.items():
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in series:
+            format_histogram(lines, name, labels, histogram)
+    for name, series in counters.items():
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in series:
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def stage_series():
+    with histograms_lock:
+        items = sorted(stage_histograms.items())
+    return [([('stage', stage), ('board', board)], histogram) for (stage, board), histogram in items]
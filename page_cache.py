@@ -0,0 +1,94 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+MAX_BYTES = 32 * 1024 * 1024
+
+
+def encodings():
+    # what we can send, best first
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, GZIP_LEVEL)
+    return body
+
+
+class PageEntry(object):
+    def __init__(self, etag, html):
+        self.etag = etag
+        self.bodies = {'identity': html}
+
+    def size(self):
+        return sum(len(body) for body in self.bodies.values())
+
+
+class PageCache(object):
+    # whole rendered pages, one entry per page and cookie state, along with each
+    # compressed body as it is first asked for. a new etag replaces the entry,
+    # so every client gets the same bytes until the board changes. LRU-evicted
+    # by total size
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag, encoding, render):
+        # render() gives the page's html, only called when it isn't cached
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.etag == etag:
+                self.entries.move_to_end(key)
+                body = entry.bodies.get(encoding)
+                if body is not None:
+                    self.hits += 1
+                    return body
+                html = entry.bodies['identity']
+            else:
+                entry = None
+            self.misses += 1
+
+        if entry is None:
+            html = render().encode('utf-8')
+            entry = PageEntry(etag, html)
+        body = compress(html, encoding)
+
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None and old.etag == etag:
+                # someone else got here first, add to theirs
+                entry = old
+            if old is not None:
+                self.bytes -= old.size()
+            entry.bodies[encoding] = body
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.bytes += entry.size()
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size()
+        return body
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'encodings': encodings(),
+            }
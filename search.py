@@ -0,0 +1,91 @@
+import bisect
+import html
+import math
+import re
+import threading
+from array import array
+
+MAX_TOKEN_CHARS = 40
+token_pattern = re.compile(r'\w+')
+tag_pattern = re.compile(r'<[^>]*>')
+
+
+def tokenize(text):
+    return [token for token in token_pattern.findall(text.lower()) if len(token) <= MAX_TOKEN_CHARS]
+
+
+def post_text(content):
+    # posts are kept as rendered html, the ansi colors are spans by then
+    return html.unescape(tag_pattern.sub(' ', content))
+
+
+class BoardIndex(object):
+    # token -> ids of the posts that have it (ascending, posts arrive in id order)
+    # and how often they have it. deleted posts stay in here, they are skipped
+    # when the board doesn't have them anymore
+    def __init__(self):
+        self.ids = {}
+        self.counts = {}
+        self.max_id = 0
+        self.posts = 0
+
+    def add(self, post_id, text):
+        counts = {}
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            if token not in self.ids:
+                self.ids[token] = array('q')
+                self.counts[token] = array('H')
+            self.ids[token].append(post_id)
+            self.counts[token].append(min(count, 65535))
+        self.max_id = max(self.max_id, post_id)
+        self.posts += 1
+
+    def search(self, tokens):
+        # every token has to be in the post, rarer tokens count for more
+        postings = [(self.ids.get(token), self.counts.get(token)) for token in set(tokens)]
+        if not postings or any(ids is None for ids, _ in postings):
+            return {}
+        postings.sort(key=lambda posting: len(posting[0]))
+        ids, counts = postings[0]
+        idf = math.log(1 + self.posts / len(ids))
+        scores = {post_id: (1 + math.log(count)) * idf for post_id, count in zip(ids, counts)}
+        for ids, counts in postings[1:]:
+            idf = math.log(1 + self.posts / len(ids))
+            matches = {}
+            # the candidates are the rarest token's posts, look each one up
+            for post_id, score in scores.items():
+                i = bisect.bisect_left(ids, post_id)
+                if i < len(ids) and ids[i] == post_id:
+                    matches[post_id] = score + (1 + math.log(counts[i])) * idf
+            scores = matches
+            if not scores:
+                break
+        return scores
+
+
+class SearchIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.boards = {}
+
+    def update(self, key, board_posts):
+        # only posts newer than what's indexed get tokenized
+        with self.lock:
+            index = self.boards.get(key)
+            if index is None or board_posts.max_id < index.max_id:
+                index = self.boards[key] = BoardIndex()
+            for post in board_posts.posts_since(index.max_id):
+                index.add(post.id, post_text(post.content))
+
+    def search(self, key, query):
+        with self.lock:
+            index = self.boards.get(key)
+            if index is None:
+                return {}
+            return index.search(tokenize(query))
+
+    def stats(self):
+        with self.lock:
+            return {key: {'tokens': len(index.ids), 'max_id': index.max_id} for key, index in self.boards.items()}
@@ -0,0 +1,279 @@
+import asyncio
+import atexit
+import codecs
+import json
+import random
+import threading
+import time
+import aiohttp
+import event_loop
+from metrics import Histogram, timed
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+POOL_SIZE = 100
+POOL_TIMEOUT = 10
+READ_RETRIES = 2
+RETRY_BACKOFF_SECS = 0.3
+RETRY_STATUSES = [502, 503, 504]
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECS = 30
+STREAM_CHUNK_BYTES = 64 * 1024
+ERROR_BODY_BYTES = 64 * 1024
+
+
+class BackendError(Exception):
+    # response is None when we never got one (timeout, refused, circuit open).
+    # text is the start of the error page, see error_text
+    def __init__(self, response=None, reason=None, text=None):
+        super().__init__(reason if response is None else response.status)
+        self.response = response
+        self.reason = reason
+        self.text = text
+
+    @property
+    def status(self):
+        return self.reason if self.response is None else self.response.status
+
+
+async def error_text(response):
+    # reads at most ERROR_BODY_BYTES of an error response and releases it, a
+    # streamed body that nobody reads would keep its connection forever
+    text = getattr(response, 'error_text', None)
+    if text is None:
+        body = b''
+        try:
+            while len(body) < ERROR_BODY_BYTES:
+                chunk = await response.content.read(ERROR_BODY_BYTES - len(body))
+                if not chunk:
+                    break
+                body += chunk
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        response.release()
+        text = response.error_text = body.decode(response.charset or 'utf-8', errors='replace')
+    return text
+
+
+class Upstream(object):
+    # one keep-alive connection pool per backend, with timeouts, retries for
+    # reads and a circuit breaker so a dead backend fails fast. requests are
+    # coroutines on the event loop, however many are in flight
+    def __init__(self, url):
+        self.url = url
+        self.session = None
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+        self.trial_running = False
+        self.latency = Histogram()
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'rejected': 0,
+            'breaker_opened': 0,
+            'latency_sum': 0.0,
+            'latency_max': 0.0,
+        }
+
+    def get_session(self):
+        # aiohttp sessions belong to the loop they were made on, this runs on ours.
+        # past POOL_SIZE connections a request waits for one, that wait counts
+        # against the connect timeout
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(connect=POOL_TIMEOUT + CONNECT_TIMEOUT,
+                    sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+        return self.session
+
+    async def get(self, path, **kwargs):
+        # the body is left to the caller, who reads it to the end or releases it
+        return await self.request('GET', path, READ_RETRIES, **kwargs)
+
+    async def post(self, path, **kwargs):
+        # posting twice is worse than failing once, no retries. only the status
+        # matters, the short body is read so the connection can be reused
+        response = await self.request('POST', path, 0, **kwargs)
+        await error_text(response)
+        return response
+
+    async def request(self, method, path, retries, data=None, headers=None, **kwargs):
+        self.before_request()
+        # requests left out None values, aiohttp would choke on them
+        if isinstance(data, dict):
+            data = {name: value for name, value in data.items() if value is not None}
+        if headers:
+            headers = {name: value for name, value in headers.items() if value is not None}
+        session = self.get_session()
+        attempt = 0
+        while True:
+            start = time.time()
+            response = None
+            error = None
+            try:
+                with timed('upstream'):
+                    response = await session.request(method, self.url + path, data=data, headers=headers, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            self.record(time.time() - start, response)
+            failed = error is not None or response.status in RETRY_STATUSES
+            if not failed or attempt >= retries:
+                break
+            attempt += 1
+            if response is not None:
+                # hand the connection back, a streamed body would keep it
+                response.release()
+            with self.lock:
+                self.stats['retries'] += 1
+            await asyncio.sleep(RETRY_BACKOFF_SECS * 2 ** (attempt - 1) * (0.5 + random.random()))
+
+        self.after_request(failed)
+        if error is not None:
+            raise BackendError(reason=type(error).__name__)
+        if failed:
+            # the caller only looks at the status (and maybe the text)
+            await error_text(response)
+        return response
+
+    def before_request(self):
+        with self.lock:
+            if time.time() < self.open_until:
+                self.stats['rejected'] += 1
+                raise BackendError(reason='backend down')
+            if self.failures >= BREAKER_FAILURES:
+                # half open, one request gets to find out if it's back
+                if self.trial_running:
+                    self.stats['rejected'] += 1
+                    raise BackendError(reason='backend down')
+                self.trial_running = True
+
+    def after_request(self, failed):
+        with self.lock:
+            self.trial_running = False
+            if not failed:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= BREAKER_FAILURES:
+                if self.failures == BREAKER_FAILURES:
+                    print(f'{self.url} failed {self.failures} times in a row, backing off')
+                self.stats['breaker_opened'] += 1
+                self.open_until = time.time() + BREAKER_RESET_SECS
+
+    def record(self, latency, response):
+        self.latency.observe(latency)
+        with self.lock:
+            self.stats['requests'] += 1
+            if response is None or response.status >= 500:
+                self.stats['errors'] += 1
+            self.stats['latency_sum'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, failures=self.failures, open=time.time() < self.open_until)
+
+
+json_decoder = json.JSONDecoder()
+whitespace = ' \t\r\n'
+
+
+class JsonListParser(object):
+    # the objects of a json list one at a time as the body comes in, so only the
+    # object being parsed and the next chunk are ever held as text. (a bare
+    # number cut off at the end of a chunk would come out short, posts are
+    # always objects)
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk):
+        # the items this chunk completes, b'' is the end of the body
+        done = not chunk
+        buffer = self.buffer + self.decoder.decode(chunk, final=done)
+        pos = 0
+        items = []
+        while not self.finished:
+            while pos < len(buffer) and buffer[pos] in whitespace:
+                pos += 1
+            if pos < len(buffer):
+                if not self.started:
+                    if buffer[pos] != '[':
+                        raise BackendError(reason='not a list')
+                    self.started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    self.finished = True
+                    break
+                if buffer[pos] == ',':
+                    pos += 1
+                    continue
+                try:
+                    item, end = json_decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    # most likely cut off at the end of the chunk, try again with more
+                    if done:
+                        raise BackendError(reason='bad json')
+                    break
+                pos = end
+                items.append(item)
+                continue
+            if done:
+                raise BackendError(reason='truncated json')
+            break
+        self.buffer = buffer[pos:]
+        return items
+
+
+async def iter_json_list(response):
+    # the posts of a list response as the body is read, released at the end
+    # (or when the caller stops early and closes the generator)
+    parser = JsonListParser()
+    try:
+        while not parser.finished:
+            try:
+                chunk = await response.content.read(STREAM_CHUNK_BYTES)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise BackendError(reason=type(e).__name__)
+            for item in parser.feed(chunk):
+                yield item
+    finally:
+        response.release()
+
+
+upstreams_lock = threading.Lock()
+upstreams = {}
+
+
+def upstream_for(url):
+    with upstreams_lock:
+        if url not in upstreams:
+            upstreams[url] = Upstream(url)
+        return upstreams[url]
+
+
+def upstream_latencies():
+    with upstreams_lock:
+        return {url: upstream.latency for url, upstream in upstreams.items()}
+
+
+def upstream_stats():
+    with upstreams_lock:
+        items = list(upstreams.items())
+    return {url: upstream.get_stats() for url, upstream in items}
+
+
+@atexit.register
+def close_sessions():
+    # unclosed aiohttp sessions complain on the way out
+    with upstreams_lock:
+        sessions = [upstream.session for upstream in upstreams.values() if upstream.session is not None]
+    if sessions:
+        async def close():
+            await asyncio.gather(*(session.close() for session in sessions))
+        event_loop.run(close())
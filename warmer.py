@@ -0,0 +1,91 @@
+import asyncio
+import random
+import threading
+import time
+import event_loop
+
+MIN_INTERVAL_SECS = 5
+MAX_INTERVAL_SECS = 120
+START_SPREAD_SECS = 3
+JITTER = 0.2
+RATE_SMOOTHING = 0.3
+
+
+class WarmTarget(object):
+    # refresh() is a coroutine that reloads one cache entry and returns how far
+    # the board's post ids go, the difference between two refreshes is how many
+    # posts came in
+    def __init__(self, key, refresh):
+        self.key = key
+        self.refresh = refresh
+        self.last_id = None
+        self.last_time = None
+        self.rate = 0.0
+        self.interval = MAX_INTERVAL_SECS
+        self.refreshes = 0
+        self.failures = 0
+
+    async def run(self):
+        await asyncio.sleep(random.uniform(0, START_SPREAD_SECS))
+        while True:
+            try:
+                max_id = await self.refresh()
+            except Exception as e:
+                print(f'warming {self.key} failed: {e!r}')
+                self.failures += 1
+                self.interval = min(self.interval * 2, MAX_INTERVAL_SECS)
+            else:
+                self.refreshes += 1
+                self.update_rate(max_id)
+            # jittered so boards (and gunicorn workers) don't all go at once
+            await asyncio.sleep(self.interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+    def update_rate(self, max_id):
+        now = time.time()
+        if self.last_id is not None and now > self.last_time:
+            rate = max(max_id - self.last_id, 0) / (now - self.last_time)
+            self.rate += RATE_SMOOTHING * (rate - self.rate)
+        self.last_id = max_id
+        self.last_time = now
+        # about one new post between refreshes
+        if self.rate > 0:
+            self.interval = min(max(1 / self.rate, MIN_INTERVAL_SECS), MAX_INTERVAL_SECS)
+        else:
+            self.interval = MAX_INTERVAL_SECS
+
+
+class CacheWarmer(object):
+    # keeps every configured board loaded so readers get a cached copy instead of
+    # waiting on the backend, busy boards are refreshed more often than quiet ones.
+    # every board is a coroutine on the event loop rather than a thread of its own
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = []
+        self.started = False
+
+    def add(self, key, refresh):
+        target = WarmTarget(key, refresh)
+        with self.lock:
+            self.targets.append(target)
+            if self.started:
+                event_loop.submit(target.run())
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            for target in self.targets:
+                event_loop.submit(target.run())
+
+    def stats(self):
+        with self.lock:
+            return {
+                target.key: {
+                    'interval': round(target.interval, 1),
+                    'posts_per_min': round(target.rate * 60, 2),
+                    'refreshes': target.refreshes,
+                    'failures': target.failures,
+                }
+                for target in self.targets
+            }